@@ -2,12 +2,18 @@ import os
 import re
 import time
 import json
+import argparse
 import pytz
 import requests
+import em_transport
+import nav_panel
+from zigzag import ZigZagTracker
+from indicators import compute_indicators
 import datetime
 import pandas as pd
 import numpy as np
 import akshare as ak
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from supabase import create_client
 
 
@@ -16,6 +22,23 @@ SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 FEISHU_HOOK = "https://open.feishu.cn/open-apis/bot/v2/hook/31bb5f01-1e8b-4b08-8824-d634b95329e8"
 
+# 扫描调度：整次巡检的时间预算 (秒)、并发数、雷达命中上限
+SCAN_BUDGET_SEC = float(os.environ.get("SCAN_BUDGET_SEC", 240))
+SCAN_WORKERS = 8
+RADAR_MAX_HITS = 15
+
+# 雷达预筛：盘中单日估值涨幅的合理上限 (按创业板/科创板 20% 涨跌停取宽，主板 10% 的基金自然落在其内)，近1月跌幅超过阈值视为明显处于下降趋势
+PRESCREEN_MAX_DAY_MOVE = 0.20
+PRESCREEN_TREND_DROP = 0.12
+
+# 常驻模式：估值轮询间隔 (分钟)
+DAEMON_INTERVAL_MIN = 5
+
+# 夜间特征库：动能窗口、拐点偏离阈值与保留的拐点数
+FEATURE_MOM_WINDOWS = (20, 60, 120)
+FEATURE_PIVOT_DEV = 0.05
+FEATURE_PIVOT_KEEP = 12
+
 print("DEBUG: 执行的是满血增强版 v2.0")
 
 def get_bj_time():
@@ -24,30 +47,64 @@ def get_bj_time():
 
 # === 2. 核心引擎类 ===
 class IndicatorEngine:
+    COLUMNS = ['ema_21', 'ema_55', 'ema_89', 'high_20', 'low_20', 'ao', 'ao_prev', 'tr', 'atr']
+    # tail_state / WaveEngine 只读这几列
+    TAIL_COLUMNS = ['ema_89', 'high_20', 'low_20', 'ao', 'ao_prev']
+
     @staticmethod
-    def calculate_indicators(df: pd.DataFrame) -> pd.DataFrame:
+    def calculate_indicators(df: pd.DataFrame, columns=None) -> pd.DataFrame:
+        """columns 指定时只计算这些列 (及其依赖)"""
         if df.empty: return df
-        data = df.copy()
-        # 均线系统
-        data['ema_21'] = data['nav'].ewm(span=21, adjust=False).mean()
-        data['ema_55'] = data['nav'].ewm(span=55, adjust=False).mean()
-        data['ema_89'] = data['nav'].ewm(span=89, adjust=False).mean()
-        # 通道系统
-        data['high_20'] = data['nav'].rolling(window=20).max()
-        data['low_20'] = data['nav'].rolling(window=20).min()
-        # 动能系统
-        data['ao'] = data['nav'].rolling(window=5).mean() - data['nav'].rolling(window=34).mean()
-        data['ao_prev'] = data['ao'].shift(1)
-        # 波动率 ATR
-        data['tr'] = data['nav'].diff().abs()
-        data['atr'] = data['tr'].rolling(window=14).mean()
-        return data
+        return compute_indicators(df, columns or IndicatorEngine.COLUMNS)
+
+    @staticmethod
+    def tail_state(data: pd.DataFrame) -> dict:
+        """
+        抽取官方净值序列的指标末端状态 (需先 calculate_indicators)。
+        盘中估值只影响最后一根K线，在此状态上 O(1) 外推即可，无需重算整段历史。
+        """
+        if len(data) < 2: return {}
+        nav = data['nav']
+        last, prev = data.iloc[-1], data.iloc[-2]
+        return {
+            'n': len(data), 'date': str(data.index[-1].date()),
+            'nav': float(last['nav']), 'ema_89': float(last['ema_89']),
+            'high_20': float(last['high_20']), 'low_20': float(last['low_20']),
+            'high_20_prev': float(prev['high_20']), 'low_20_prev': float(prev['low_20']),
+            'ao': float(last['ao']), 'ao_prev': float(prev['ao']),
+            'sum_4': float(nav.iloc[-4:].sum()), 'sum_33': float(nav.iloc[-33:].sum()),
+        }
+
+    @staticmethod
+    def extend_tail(state: dict, est: float) -> dict:
+        """在末端状态后追加一根估值K线，返回 WaveEngine.decide 所需的末根指标"""
+        alpha = 2 / (89 + 1)
+        return {
+            'n': state['n'] + 1, 'nav': est,
+            'ema_89': state['ema_89'] + alpha * (est - state['ema_89']),
+            # 通道取前一根 (即最后一个官方净值) 的值
+            'high_20': state['high_20'], 'low_20': state['low_20'],
+            'ao': (state['sum_4'] + est) / 5 - (state['sum_33'] + est) / 34,
+            'ao_prev': state['ao'],
+        }
+
+    @staticmethod
+    def official_bar(state: dict) -> dict:
+        """无实时估值时，按最后一个官方净值给出末根指标"""
+        return {
+            'n': state['n'], 'nav': state['nav'], 'ema_89': state['ema_89'],
+            'high_20': state['high_20_prev'], 'low_20': state['low_20_prev'],
+            'ao': state['ao'], 'ao_prev': state['ao_prev'],
+        }
 
 class DataService:
     @staticmethod
     def fetch_nav_history(code):
+        # 本地净值面板足够新时直接映射读取，免去网络请求
+        cached = nav_panel.lookup(code, nav_panel.required_nav_date(get_bj_time()))
+        if cached is not None: return cached
         try:
-            df = ak.fund_open_fund_info_em(symbol=code, indicator="单位净值走势")
+            df = em_transport.ak_call(ak.fund_open_fund_info_em, symbol=code, indicator="单位净值走势")
             if df.empty: return pd.DataFrame()
             df = df.rename(columns={"净值日期": "date", "单位净值": "nav"})
             df['date'] = pd.to_datetime(df['date'])
@@ -58,38 +115,68 @@ class DataService:
         except: return pd.DataFrame()
 
     @staticmethod
-    def get_realtime_estimate(code):
-        """抓取实时估值"""
-        try:
-            url = f"http://fundgz.1234567.com.cn/js/{code}.js?rt={int(time.time())}"
-            r = requests.get(url, timeout=3)
-            match = re.findall(r'\((.*?)\)', r.text)
-            if match:
-                data = json.loads(match[0])
-                return float(data['gsz']), float(data['gszzl'])
-            return None, None
+    def get_realtime_estimate(code, hedge=False):
+        """抓取实时估值 (hedge=True 用于持仓：接口迟迟不回时补发一次对冲请求)"""
+        data = em_transport.fetch_estimate(code, timeout=3, hedge=hedge)
+        if not data: return None, None
+        try: return float(data['gsz']), float(data['gszzl'])
         except: return None, None
 
     @staticmethod
     def get_market_wide_pool():
-        """获取全市场 Top 300 品种"""
+        """获取全市场 Top 300 品种 (附带近1周/近1月收益，供雷达预筛)"""
         try:
-            df = ak.fund_open_fund_rank_em(symbol="全部")
+            df = em_transport.ak_call(ak.fund_open_fund_rank_em, symbol="全部")
             mask = df['基金简称'].str.contains('债|货币|理财|定开|持有|养老|以太|比特', regex=True) == False
-            df = df[mask].dropna(subset=['近6月']).sort_values(by="近6月", ascending=False)
-            return [{"code": str(row['基金代码']), "name": row['基金简称']} for _, row in df.head(300).iterrows()]
+            df = df[mask].dropna(subset=['近6月']).sort_values(by="近6月", ascending=False).head(300)
+            r_1w = pd.to_numeric(df['近1周'], errors='coerce') / 100
+            r_1m = pd.to_numeric(df['近1月'], errors='coerce') / 100
+            return [
+                {"code": str(code), "name": name, "r_1w": w, "r_1m": m}
+                for code, name, w, m in zip(df['基金代码'], df['基金简称'], r_1w, r_1m)
+            ]
         except: return []
 
 class WaveEngine:
+    @staticmethod
+    def prescreen_pool(pool):
+        """
+        雷达预筛 (只用排行榜收益列，向量化)：剔除今天不可能给出 Buy 的品种，省掉它们的历史下载。
+        Buy 需要现价突破前 20 日最高，因此至少要高于一周前的净值；近1月大幅下跌的视为趋势向下。
+        缺少收益数据的品种保留。
+        """
+        if not pool: return [], 0
+        r_1w = np.array([f.get('r_1w', np.nan) for f in pool], dtype=float)
+        r_1m = np.array([f.get('r_1m', np.nan) for f in pool], dtype=float)
+        no_breakout = (1 + r_1w) * (1 + PRESCREEN_MAX_DAY_MOVE) <= 1
+        below_trend = r_1m <= -PRESCREEN_TREND_DROP
+        keep = ~(no_breakout | below_trend)
+        survivors = [f for f, k in zip(pool, keep) if k]
+        return survivors, len(pool) - len(survivors)
+
     @staticmethod
     def analyze_structure(df_slice):
         if len(df_slice) < 60: return {'status': 'Wait', 'score': 0, 'desc': '数据不足'}
-        last_nav = df_slice['nav'].iloc[-1]
-        ema89 = df_slice['ema_89'].iloc[-1]
-        high_20 = df_slice['high_20'].iloc[-2]
-        low_20 = df_slice['low_20'].iloc[-2]
-        ao_curr = df_slice['ao'].iloc[-1]
-        ao_prev = df_slice['ao_prev'].iloc[-1]
+        return WaveEngine.decide({
+            'n': len(df_slice),
+            'nav': df_slice['nav'].iloc[-1],
+            'ema_89': df_slice['ema_89'].iloc[-1],
+            'high_20': df_slice['high_20'].iloc[-2],
+            'low_20': df_slice['low_20'].iloc[-2],
+            'ao': df_slice['ao'].iloc[-1],
+            'ao_prev': df_slice['ao_prev'].iloc[-1],
+        })
+
+    @staticmethod
+    def decide(bar):
+        """末根K线判定 (bar 来自完整指标表或 IndicatorEngine 的末端外推)"""
+        if bar['n'] < 60: return {'status': 'Wait', 'score': 0, 'desc': '数据不足'}
+        last_nav = bar['nav']
+        ema89 = bar['ema_89']
+        high_20 = bar['high_20']
+        low_20 = bar['low_20']
+        ao_curr = bar['ao']
+        ao_prev = bar['ao_prev']
         
         # 卖出判定
         if last_nav < ema89: return {'status': 'Sell', 'score': -100, 'desc': '破位：跌破生命线(EMA89)'}
@@ -102,13 +189,236 @@ class WaveEngine:
             return {'status': 'Buy', 'score': 75, 'desc': '突破：20日新高 (等待动能放量)'}
         return {'status': 'Hold', 'score': 50, 'desc': '震荡整理中'}
 
+class ScanScheduler:
+    """
+    带截止时间的并发扫描器：
+    先整批跑高优先级任务 (持仓/模拟盘)，再用剩余预算按排名滚动提交雷达任务，
+    命中数达到上限或预算耗尽即停止提交。超时未完成的任务直接丢弃，不阻塞推送。
+    """
+    def __init__(self, budget_sec, workers=SCAN_WORKERS):
+        self.deadline = time.monotonic() + budget_sec
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    @staticmethod
+    def _collect(future, results, idx, errors=None):
+        try:
+            results[idx] = future.result()
+            return True
+        except Exception as e:
+            if errors is not None: errors[idx] = e
+            return False
+
+    def run_all(self, fn, items):
+        """全部提交，最多等到截止时间；返回 ({序号: 结果}, {序号: 异常})，超时未完成的两者都不在其中"""
+        futures = {self.pool.submit(fn, item): i for i, item in enumerate(items)}
+        done, pending = wait(futures, timeout=self.remaining())
+        for f in pending: f.cancel()
+        results, errors = {}, {}
+        for f in done: self._collect(f, results, futures[f], errors)
+        return results, errors
+
+    def run_until(self, fn, items, is_hit, max_hits):
+        """按顺序滚动提交 (在途最多 2×workers)，返回 ({序号: 结果}, 停止原因)"""
+        results, inflight = {}, {}
+        queue = iter(enumerate(items))
+        hits, reason, exhausted = 0, "全部完成", False
+        while True:
+            while not exhausted and hits < max_hits and len(inflight) < self.workers * 2 and self.remaining() > 0:
+                nxt = next(queue, None)
+                if nxt is None:
+                    exhausted = True
+                    break
+                inflight[self.pool.submit(fn, nxt[1])] = nxt[0]
+            if not inflight: break
+            if self.remaining() <= 0:
+                reason = "时间预算耗尽"
+                break
+            done, _ = wait(inflight, timeout=self.remaining(), return_when=FIRST_COMPLETED)
+            for f in done:
+                idx = inflight.pop(f)
+                if self._collect(f, results, idx) and is_hit(results[idx]): hits += 1
+            if hits >= max_hits: reason = f"已命中 {max_hits} 只"
+        for f in inflight: f.cancel()
+        if not exhausted and reason == "全部完成": reason = "时间预算耗尽"
+        return results, reason
+
+    def close(self):
+        # 不等待仍在网络请求中的线程，保证推送准时发出
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+def scan_fund(code, tail=None, hedge=False):
+    """
+    单只基金巡检：实时估值 + 指标末端状态 + 结构判定。
+    传入当日快照中的 tail 时跳过历史下载，只刷新估值并重算末根K线。
+    """
+    est_p, _ = DataService.get_realtime_estimate(code, hedge=hedge)
+    if tail is None:
+        with em_transport.lane("holdings" if hedge else None):
+            tail = load_tail(code)
+    if not tail:
+        return {"code": code, "price": est_p or 0, "ans": {'status': 'Wait', 'score': 0, 'desc': '数据不足'}, "tail": tail}
+    bar = IndicatorEngine.extend_tail(tail, est_p) if est_p else IndicatorEngine.official_bar(tail)
+    return {"code": code, "price": est_p or tail['nav'], "ans": WaveEngine.decide(bar), "tail": tail}
+
+def load_tail(code):
+    df = IndicatorEngine.calculate_indicators(DataService.fetch_nav_history(code), columns=IndicatorEngine.TAIL_COLUMNS)
+    return IndicatorEngine.tail_state(df)
+
+def is_radar_buy(ans):
+    # 放宽条件：评分≥70 即可（可选）
+    return ans['status'] == 'Buy' and ans['score'] >= 70
+
+def load_portfolio(supabase):
+    res = supabase.table("trader_storage").select("portfolio_data").eq("id", "default_user").execute()
+    return res.data[0]['portfolio_data'] if res.data else {}
+
+def _json_safe(obj):
+    """NaN -> None (Supabase jsonb 不接受 NaN)"""
+    if isinstance(obj, dict): return {k: _json_safe(v) for k, v in obj.items()}
+    if isinstance(obj, list): return [_json_safe(v) for v in obj]
+    if isinstance(obj, float) and obj != obj: return None
+    return obj
+
+class ScanStateStore:
+    """
+    巡检快照：当日的雷达池、各基金指标末端状态与已推送过的基金。
+    官方净值盘中不会变化，同一交易日的后续巡检 (14:30) 只需刷新估值、重算末根K线。
+    GitHub Actions 每次都是全新环境，快照存放在 trader_storage 表的独立一行。
+    """
+    ROW_ID = "cron_scan_state"
+
+    def __init__(self, supabase):
+        self.supabase = supabase
+
+    def load(self, trade_date):
+        try:
+            res = self.supabase.table("trader_storage").select("portfolio_data").eq("id", self.ROW_ID).execute()
+            snap = res.data[0]['portfolio_data'] if res.data else {}
+        except Exception as e:
+            print(f"读取巡检快照失败: {e}")
+            return {}
+        if not snap or snap.get('trade_date') != trade_date: return {}
+        # None 还原为 NaN，保持与 tail_state 的数值语义一致
+        snap['tails'] = {c: {k: (np.nan if v is None else v) for k, v in t.items()} for c, t in snap.get('tails', {}).items()}
+        return snap
+
+    def save(self, snapshot):
+        try:
+            self.supabase.table("trader_storage").upsert({"id": self.ROW_ID, "portfolio_data": _json_safe(snapshot)}).execute()
+        except Exception as e:
+            print(f"保存巡检快照失败: {e}")
+
+def prev_trading_day(now):
+    """今天之前最近的交易日 (按 nav_panel 的交易日历)：夜间特征库应至少包含这一天的官方净值"""
+    return str(nav_panel.previous_trading_day(now.date()))
+
+def load_trading_calendar():
+    """装入交易所交易日历；失败时 nav_panel 按工作日近似"""
+    try:
+        df = em_transport.ak_call(ak.tool_trade_date_hist_sina)
+        nav_panel.set_trading_calendar([str(d)[:10] for d in df['trade_date']])
+    except Exception as e:
+        print(f"交易日历获取失败，按工作日近似: {e}")
+
+class FeatureStore:
+    """
+    夜间特征库：官方净值发布后 (--build-features) 为全市场池 + 持仓 + 模拟交易台的每只基金
+    计算指标末端状态、20/60/120 日动能、近期拐点与信号状态，按列存入 trader_storage 的独立一行：
+    {"nav_date", "built_at", "codes": [...], "columns": {列名: [逐基金的值]}, "pivots": [[[日期, 净值, 类型], ...]]}。
+    白天的巡检 / 看板直接读取，只需叠加盘中估值。
+    """
+    ROW_ID = "feature_store"
+    TAIL_COLS = ('n', 'date', 'nav', 'ema_89', 'high_20', 'low_20', 'high_20_prev', 'low_20_prev', 'ao', 'ao_prev', 'sum_4', 'sum_33')
+
+    def __init__(self, supabase):
+        self.supabase = supabase
+
+    @staticmethod
+    def compute(code):
+        """单只基金的一行特征 (历史不足时返回 None)"""
+        df = IndicatorEngine.calculate_indicators(DataService.fetch_nav_history(code))
+        tail = IndicatorEngine.tail_state(df)
+        if not tail: return None
+        nav = df['nav'].to_numpy(dtype=float)
+        row = dict(tail)
+        row['ema_21'] = float(df['ema_21'].iloc[-1]); row['ema_55'] = float(df['ema_55'].iloc[-1])
+        row['atr'] = float(df['atr'].iloc[-1])
+        for w in FEATURE_MOM_WINDOWS:
+            row[f'mom_{w}'] = float(nav[-1] / nav[-w] - 1) if len(nav) > w else np.nan
+        ans = WaveEngine.analyze_structure(df)
+        row['status'], row['score'] = ans['status'], ans['score']
+        pivots = ZigZagTracker.from_series(df['nav'], FEATURE_PIVOT_DEV).pivots()[-FEATURE_PIVOT_KEEP:] if len(df) >= 10 else []
+        row['pivots'] = [[str(p['date'].date()), float(p['val']), p['type']] for p in pivots]
+        return row
+
+    def build(self, codes, workers=SCAN_WORKERS):
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            rows = dict(zip(codes, pool.map(self.compute, codes)))
+        rows = {c: r for c, r in rows.items() if r}
+        kept = list(rows)
+        columns = [k for k in next(iter(rows.values()), {}) if k != 'pivots']
+        return {
+            "nav_date": max((r['date'] for r in rows.values()), default=None),
+            "built_at": get_bj_time().strftime('%Y-%m-%d %H:%M'),
+            "codes": kept,
+            "columns": {col: [rows[c][col] for c in kept] for col in columns},
+            "pivots": [rows[c]['pivots'] for c in kept],
+        }
+
+    def save(self, table):
+        try:
+            self.supabase.table("trader_storage").upsert({"id": self.ROW_ID, "portfolio_data": _json_safe(table)}).execute()
+        except Exception as e:
+            print(f"保存特征库失败: {e}")
+
+    def load(self, min_nav_date):
+        """读取特征库；净值日期早于 min_nav_date (构建失败 / 过期) 时返回 {}"""
+        try:
+            res = self.supabase.table("trader_storage").select("portfolio_data").eq("id", self.ROW_ID).execute()
+            table = res.data[0]['portfolio_data'] if res.data else {}
+        except Exception as e:
+            print(f"读取特征库失败: {e}")
+            return {}
+        if not table or (table.get('nav_date') or '') < min_nav_date: return {}
+        return table
+
+    @classmethod
+    def tails(cls, table, min_nav_date):
+        """
+        特征库 -> {code: tail_state}，可直接交给 scan_fund / IndicatorEngine.extend_tail。
+        表级 nav_date 只是各行的最大值：构建时官方净值尚未发布的基金末根停在更早的日期，
+        这些行不返回，由调用方现场下载 (否则盘中估值会被当成旧末根的下一根)。
+        """
+        if not table: return {}
+        cols = table['columns']
+        return {
+            code: {k: (np.nan if cols[k][i] is None else cols[k][i]) for k in cls.TAIL_COLS}
+            for i, code in enumerate(table['codes']) if cols['date'][i] >= min_nav_date
+        }
+
+def push_card(title, content, template="blue", note=None):
+    """飞书卡片推送"""
+    elements = [{"tag": "div", "text": {"content": content, "tag": "lark_md"}}]
+    if note:
+        elements += [{"tag": "hr"}, {"tag": "note", "elements": [{"content": note, "tag": "plain_text"}]}]
+    payload = {
+        "msg_type": "interactive",
+        "card": {
+            "header": {"title": {"content": title, "tag": "plain_text"}, "template": template},
+            "elements": elements
+        }
+    }
+    requests.post(FEISHU_HOOK, json=payload, timeout=20)
+
 # === 3. 执行逻辑 ===
 def run_cron_mission():
     bj_now = get_bj_time()
     supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    res = supabase.table("trader_storage").select("portfolio_data").eq("id", "default_user").execute()
-    
-    portfolio = res.data[0]['portfolio_data'] if res.data else {}
+    portfolio = load_portfolio(supabase)
     
     # 获取不同类型的池子
     real_holdings = portfolio.get('holdings', [])
@@ -116,30 +426,40 @@ def run_cron_mission():
     
     capital = portfolio.get('capital', 20000)
     sections = []
+    scheduler = ScanScheduler(SCAN_BUDGET_SEC)
+    
+    # 当日快照：复用上一次巡检的雷达池和指标末端状态；首次巡检从夜间特征库取末端状态
+    store = ScanStateStore(supabase)
+    snapshot = store.load(str(bj_now.date()))
+    min_nav_date = prev_trading_day(bj_now)
+    tails = {**FeatureStore.tails(FeatureStore(supabase).load(min_nav_date), min_nav_date), **snapshot.get('tails', {})}
+    alerted_before = set(snapshot.get('alerted', []))
 
     # --- A. 深度风控巡检 (涵盖持仓 & 模拟交易台) ---
     sell_alerts = []
+    alerted = set()
     scan_pool = [
         {"data": h, "type": "实盘持仓"} for h in real_holdings
     ] + [
         {"data": p, "type": "模拟交易"} for p in pending_list
     ]
 
-    for item in scan_pool:
+    # 持仓/模拟盘优先：整批并发，占用预算的头部
+    patrol_results, patrol_errors = scheduler.run_all(lambda item: scan_fund(item['data']['code'], tails.get(item['data']['code']), hedge=True), scan_pool)
+    missed, failed = [], []
+
+    for i, item in enumerate(scan_pool):
         h = item['data']
         h_type = item['type']
+        if i in patrol_errors:
+            failed.append(f"{h['name']} ({h['code']}): {type(patrol_errors[i]).__name__}")
+            continue
+        if i not in patrol_results:
+            missed.append(f"{h['name']} ({h['code']})")
+            continue
         
-        est_p, _ = DataService.get_realtime_estimate(h['code'])
-        df = DataService.fetch_nav_history(h['code'])
-        
-        if est_p: 
-            new_row = pd.DataFrame({'nav': [est_p]}, index=[bj_now])
-            df = pd.concat([df, new_row])
-            
-        df = IndicatorEngine.calculate_indicators(df)
-        ans = WaveEngine.analyze_structure(df)
-        
-        price_now = est_p or (df['nav'].iloc[-1] if not df.empty else 0)
+        ans = patrol_results[i]['ans']
+        price_now = patrol_results[i]['price']
         
         # 判定 Sell 信号
         is_wave_sell = ans['status'] == 'Sell'
@@ -147,36 +467,46 @@ def run_cron_mission():
         
         if is_wave_sell or is_stop_loss:
             reason = ans['desc'] if is_wave_sell else f"跌破止损位({h['stop_loss']})"
-            sell_alerts.append(f"🚨 **[{h_type}] 卖出建议**: {h['name']} ({h['code']})\n   • 现价:{price_now:.4f} | 原因: {reason}")
+            repeat = " (此前已提示)" if h['code'] in alerted_before else ""
+            sell_alerts.append(f"🚨 **[{h_type}] 卖出建议**: {h['name']} ({h['code']}){repeat}\n   • 现价:{price_now:.4f} | 原因: {reason}")
+            alerted.add(h['code'])
     
     # 构造预警板块内容
     if sell_alerts:
         sections.append("🔥 **持仓/模拟风控预警**\n" + "\n".join(sell_alerts))
     else:
         sections.append("✅ **风险巡检**: 当前持仓及模拟交易台表现正常，未发现 Sell 卖出信号。")
+    if missed:
+        sections[-1] += f"\n⏱️ 超时未完成巡检: {', '.join(missed)}"
+    if failed:
+        sections[-1] += f"\n⚠️ 巡检出错: {', '.join(failed)}"
 
     # --- B. 全市场雷达 (Top 15 & 取消 A/C 去重) ---
     buy_opps = []
-    market_pool = DataService.get_market_wide_pool()
+    if snapshot.get('pool'):
+        market_pool, prescreened = snapshot['pool'], snapshot.get('prescreened', 0)
+    else:
+        market_pool, prescreened = WaveEngine.prescreen_pool(DataService.get_market_wide_pool())
+    radar_results, stop_reason = scheduler.run_until(
+        lambda fund: scan_fund(fund['code'], tails.get(fund['code'])), market_pool, lambda r: is_radar_buy(r['ans']), RADAR_MAX_HITS
+    )
+    scheduler.close()
     
-    for fund in market_pool:
-        est_m, _ = DataService.get_realtime_estimate(fund['code'])
-        df_m = DataService.fetch_nav_history(fund['code'])
-        if est_m and not df_m.empty:
-            new_row = pd.DataFrame({'nav': [est_m]}, index=[bj_now])
-            df_m = pd.concat([df_m, new_row])
-        
-        df_m = IndicatorEngine.calculate_indicators(df_m)
-        ans_m = WaveEngine.analyze_structure(df_m)
-        
-        # 放宽条件：评分≥70 即可（可选）
-        if ans_m['status'] == 'Buy' and ans_m['score'] >= 70:
-            total_assets = capital + sum([h['shares'] * h['cost'] for h in real_holdings])
-            suggest_amt = total_assets * 0.1
-            buy_opps.append(f"✅ **{fund['name']}** ({fund['code']})\n   • 评分: {ans_m['score']} | 建议单位: ¥{suggest_amt:,.0f}\n   • 原因: {ans_m['desc']}")
-        
-        # 最多显示15只
-        if len(buy_opps) >= 15: break
+    all_results = list(patrol_results.values()) + list(radar_results.values())
+    reused = sum(1 for r in all_results if r['code'] in tails)
+    
+    total_assets = capital + sum([h['shares'] * h['cost'] for h in real_holdings])
+    suggest_amt = total_assets * 0.1
+    # 并发完成顺序不定，按原排名 (近6月) 输出，最多显示15只
+    for i in sorted(radar_results):
+        ans_m = radar_results[i]['ans']
+        if not is_radar_buy(ans_m): continue
+        fund = market_pool[i]
+        repeat = " (此前已提示)" if fund['code'] in alerted_before else ""
+        alerted.add(fund['code'])
+        buy_opps.append(f"✅ **{fund['name']}** ({fund['code']}){repeat}\n   • 评分: {ans_m['score']} | 建议单位: ¥{suggest_amt:,.0f}\n   • 原因: {ans_m['desc']}")
+        if len(buy_opps) >= RADAR_MAX_HITS: break
+    coverage = f"雷达覆盖: {len(radar_results)}/{len(market_pool)} 品种 (预筛剔除 {prescreened} 只, {stop_reason}) | 快照复用: {reused} 只"
 
     # 动态标题：显示实际数量
     sections.append(f"🔭 **选股雷达 (强动能 Top {len(buy_opps)})**\n" + ("\n".join(buy_opps) if buy_opps else "⚪ 暂无符合突破条件的强信号。"))
@@ -184,25 +514,138 @@ def run_cron_mission():
     # --- C. 飞书卡片组装 ---
     content = "\n\n---\n\n".join(sections)
     template = "red" if sell_alerts else "blue"
+    note = f"账户现金: ¥{capital:,.0f} | 实盘持仓: {len(real_holdings)}只 | 模拟交易台: {len(pending_list)}只 | {coverage}"
+    push_card(f"🌊 波浪策略巡检 ({bj_now.strftime('%H:%M')})", content, template, note)
     
-    payload = {
-        "msg_type": "interactive",
-        "card": {
-            "header": {"title": {"content": f"🌊 波浪策略巡检 ({bj_now.strftime('%H:%M')})", "tag": "plain_text"}, "template": template},
-            "elements": [
-                {"tag": "div", "text": {"content": content, "tag": "lark_md"}},
-                {"tag": "hr"},
-                {"tag": "note", "elements": [{"content": f"账户现金: ¥{capital:,.0f} | 实盘持仓: {len(real_holdings)}只 | 模拟交易台: {len(pending_list)}只 | 本次扫描: Top 300 品种", "tag": "plain_text"}]}
-            ]
-        }
-    }
-    
-    requests.post(FEISHU_HOOK, json=payload, timeout=20)
+    # --- D. 保存当日快照，供下一次巡检复用 ---
+    for r in all_results:
+        if r['tail']: tails[r['code']] = r['tail']
+    store.save({
+        "trade_date": str(bj_now.date()),
+        "saved_at": bj_now.strftime('%H:%M'),
+        "pool": market_pool,
+        "prescreened": prescreened,
+        "tails": tails,
+        "alerted": sorted(alerted_before | alerted),
+    })
+
+def build_feature_store():
+    """夜间任务：官方净值发布后为全市场池与持仓构建特征库"""
+    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    portfolio = load_portfolio(supabase)
+    codes = [f['code'] for f in DataService.get_market_wide_pool()]
+    codes += [x['code'] for x in portfolio.get('holdings', []) + portfolio.get('pending_orders', [])]
+    codes = list(dict.fromkeys(codes))
+    t0 = time.monotonic()
+    # 先整体下载并写入本地净值面板，之后的特征计算直接读面板；面板由 nightly_features 工作流的
+    # actions/cache 在两次夜间任务间保留，次晨的补跑只需下载晚发布 (面板里还不够新) 的基金
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        histories = dict(zip(codes, pool.map(DataService.fetch_nav_history, codes)))
+    try: nav_panel.merge(histories)
+    except OSError as e: print(f"写入净值面板失败: {e}")
+    store = FeatureStore(supabase)
+    table = store.build(codes)
+    store.save(table)
+    print(f"特征库已构建: {len(table['codes'])}/{len(codes)} 只, 净值日期 {table['nav_date']}, 耗时 {time.monotonic() - t0:.1f}s")
+
+# === 4. 盘中常驻模式 ===
+def is_trading_time(now):
+    """A股连续竞价时段 (北京时间)"""
+    if now.weekday() >= 5: return False
+    hm = now.hour * 100 + now.minute
+    return 930 <= hm <= 1130 or 1300 <= hm <= 1500
+
+class IntradayDaemon:
+    """
+    盘中常驻巡检：开盘时一次性加载历史净值并抽取指标末端状态，
+    之后每隔 N 分钟批量拉取估值，只对估值变化的基金做 O(1) 末端重算，
+    信号发生跳变时 (持仓转 Sell/止损、雷达转 Buy) 推送飞书。
+    """
+    def __init__(self, interval_min=DAEMON_INTERVAL_MIN):
+        self.interval = interval_min * 60
+        self.supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+        self.pool = ThreadPoolExecutor(max_workers=SCAN_WORKERS)
+        self.watch = {}        # code -> {name, type, stop_loss, tail}
+        self.last_est = {}     # code -> 上一次估值
+        self.last_status = {}  # code -> 上一次信号
+
+    def load(self):
+        portfolio = load_portfolio(self.supabase)
+        market_pool, _ = WaveEngine.prescreen_pool(DataService.get_market_wide_pool())
+        entries = [{**f, "type": "雷达"} for f in market_pool]
+        entries += [{**p, "type": "模拟交易"} for p in portfolio.get('pending_orders', [])]
+        entries += [{**h, "type": "实盘持仓"} for h in portfolio.get('holdings', [])]
+        # 同一代码以持仓身份为准 (后写覆盖)
+        targets = {e['code']: e for e in entries}
+        # 夜间特征库已有的直接用，其余现场下载历史
+        min_nav_date = prev_trading_day(get_bj_time())
+        cached = FeatureStore.tails(FeatureStore(self.supabase).load(min_nav_date), min_nav_date)
+        missing = [c for c in targets if c not in cached]
+        tails = dict(zip(missing, self.pool.map(load_tail, missing)))
+        tails.update({c: cached[c] for c in targets if c in cached})
+        for code, e in targets.items():
+            tail = tails.get(code)
+            if not tail: continue
+            self.watch[code] = {"name": e['name'], "type": e['type'], "stop_loss": e.get('stop_loss', 0) or 0, "tail": tail}
+        print(f"常驻巡检已加载 {len(self.watch)}/{len(targets)} 只基金的指标状态 (特征库 {len(targets) - len(missing)} 只)")
+
+    def tick(self):
+        """拉取一轮估值并增量重算，返回 (状态跳变的预警, 重算数量)"""
+        codes = list(self.watch)
+        # 只有持仓 / 模拟盘对冲，雷达标的单发，避免每轮估值流量翻倍
+        ests = self.pool.map(lambda c: DataService.get_realtime_estimate(c, hedge=self.watch[c]['type'] != "雷达")[0], codes)
+        sell_alerts, buy_alerts, evaluated = [], [], 0
+        for code, est in zip(codes, ests):
+            if not est or est == self.last_est.get(code): continue
+            self.last_est[code] = est
+            evaluated += 1
+            w = self.watch[code]
+            ans = WaveEngine.decide(IndicatorEngine.extend_tail(w['tail'], est))
+            is_stop = w['type'] != "雷达" and w['stop_loss'] > 0 and est < w['stop_loss']
+            status = "Stop" if is_stop else ans['status']
+            prev = self.last_status.get(code)
+            self.last_status[code] = status
+            if status == prev: continue
+            if w['type'] == "雷达":
+                if is_radar_buy(ans):
+                    buy_alerts.append(f"✅ **{w['name']}** ({code})\n   • 估值:{est:.4f} | 评分: {ans['score']} | 原因: {ans['desc']}")
+            elif status in ("Sell", "Stop"):
+                reason = f"跌破止损位({w['stop_loss']})" if is_stop else ans['desc']
+                sell_alerts.append(f"🚨 **[{w['type']}] 卖出建议**: {w['name']} ({code})\n   • 估值:{est:.4f} | 原因: {reason}")
+        return sell_alerts, buy_alerts, evaluated
+
+    def run(self):
+        self.load()
+        while True:
+            now = get_bj_time()
+            if now.weekday() >= 5 or now.hour >= 15: break
+            if is_trading_time(now):
+                t0 = time.monotonic()
+                sell_alerts, buy_alerts, evaluated = self.tick()
+                print(f"{now.strftime('%H:%M:%S')} 重算 {evaluated}/{len(self.watch)} 只, 耗时 {time.monotonic() - t0:.2f}s")
+                sections = []
+                if sell_alerts: sections.append("🔥 **持仓/模拟风控预警**\n" + "\n".join(sell_alerts))
+                if buy_alerts: sections.append("🔭 **雷达新信号**\n" + "\n".join(buy_alerts))
+                if sections:
+                    push_card(f"🌊 盘中信号变化 ({now.strftime('%H:%M')})", "\n\n---\n\n".join(sections), "red" if sell_alerts else "blue")
+            time.sleep(self.interval)
+        self.pool.shutdown(wait=False, cancel_futures=True)
 
-# === 4. 主入口（带异常兜底） ===
+# === 5. 主入口（带异常兜底） ===
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="波浪策略巡检推送")
+    parser.add_argument("--daemon", action="store_true", help="盘中常驻模式：开盘加载一次，之后按间隔增量巡检直到收盘")
+    parser.add_argument("--interval", type=float, default=DAEMON_INTERVAL_MIN, help="常驻模式估值轮询间隔 (分钟)")
+    parser.add_argument("--build-features", action="store_true", help="夜间任务：官方净值发布后构建全市场特征库")
+    args = parser.parse_args()
+    load_trading_calendar()
     try:
-        run_cron_mission()
+        if args.build_features:
+            build_feature_store()
+        elif args.daemon:
+            IntradayDaemon(args.interval).run()
+        else:
+            run_cron_mission()
     except Exception as e:
         # 兜底报错，防止脚本静默失效
         try:
@@ -0,0 +1,324 @@
+"""
+东方财富 / 天天基金 共享 HTTP 传输层。
+
+进程内共用一个带连接池的 requests.Session (keep-alive、每主机连接上限、默认请求头、超时策略)，
+streamlit_app / ew_fund_quant / bot_cron / rt_earn 的直连请求统一走这里，避免每次重新建 TCP 连接。
+超时按各端点近期耗时分位数自适应；持仓等关键请求可在 p95 延迟后发出对冲请求，取先返回者。
+akshare 调用经 ak_call 走进程级调度器：每个接口一个令牌桶，按车道 (持仓 > 扫描 > 回测) 优先、会话间公平排队。
+相同参数的并发请求 (估值 / akshare) 合并为一次在途请求 (single-flight)，结果共享给所有等待者。
+"""
+import heapq
+import itertools
+import json
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, wait, as_completed
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Referer": "http://fund.eastmoney.com/",
+}
+POOL_HOSTS = 8       # 连接池缓存的主机数
+POOL_PER_HOST = 32   # 每主机最大连接数 (超出时阻塞等待，而不是另开连接)
+DEFAULT_TIMEOUT = (1.0, 3.0)  # (连接, 读取) 秒
+
+# 自适应超时：样本足够后取 p99 * 倍数，限制在 [下限, 上限]
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+TIMEOUT_MULT = 2.0
+TIMEOUT_FLOOR = 0.5
+TIMEOUT_CEIL = 5.0
+HEDGE_WORKERS = 8
+
+# akshare 调度：车道优先级 (数值越小越先)、各接口基准速率 (次/秒)
+LANES = {"holdings": 0, "scan": 1, "backtest": 2}
+DEFAULT_LANE = "scan"
+AK_RATES = {"fund_open_fund_info_em": 8.0, "fund_open_fund_rank_em": 0.5}
+AK_DEFAULT_RATE = 4.0
+AK_BURST_SECONDS = 2.0  # 桶容量 = 速率 * 秒数
+RATE_FLOOR = 0.5        # 连续失败时的最低速率
+RATE_CEIL_MULT = 2.0    # 持续成功最多提速到基准的倍数
+RATE_STEP = 0.1         # 每次成功的加性增量
+
+ESTIMATE_URL = "http://fundgz.1234567.com.cn/js/{code}.js"
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_hedge_pool: Optional[ThreadPoolExecutor] = None
+_trackers = {}
+
+
+class LatencyTracker:
+    """单个端点最近的请求耗时 (超时按超时值计入，端点变慢时超时随之放宽)"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock: self.samples.append(seconds)
+
+    def percentile(self, q) -> Optional[float]:
+        with self.lock: data = sorted(self.samples)
+        if len(data) < LATENCY_MIN_SAMPLES: return None
+        return data[min(len(data) - 1, int(q * len(data)))]
+
+
+def tracker(endpoint) -> LatencyTracker:
+    with _session_lock:
+        return _trackers.setdefault(endpoint, LatencyTracker())
+
+
+def adaptive_timeout(endpoint, default) -> float:
+    """冷启动用调用方给的默认值，之后按 p99 自适应"""
+    p99 = tracker(endpoint).percentile(0.99)
+    if p99 is None: return default
+    return min(max(p99 * TIMEOUT_MULT, TIMEOUT_FLOOR), TIMEOUT_CEIL)
+
+
+def hedge_delay(endpoint, default) -> float:
+    p95 = tracker(endpoint).percentile(0.95)
+    return p95 if p95 is not None else default / 2
+
+
+def session() -> requests.Session:
+    """进程级共享会话 (线程安全地懒加载)"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                s = requests.Session()
+                s.headers.update(DEFAULT_HEADERS)
+                adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_PER_HOST, pool_block=True)
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                _session = s
+    return _session
+
+
+def get(url, params=None, timeout=None, **kwargs) -> requests.Response:
+    return session().get(url, params=params, timeout=timeout or DEFAULT_TIMEOUT, **kwargs)
+
+
+def _timed_get(endpoint, url, params, timeout):
+    start = time.perf_counter()
+    try:
+        r = get(url, params=params, timeout=timeout)
+    except requests.Timeout:
+        tracker(endpoint).record(timeout)
+        raise
+    tracker(endpoint).record(time.perf_counter() - start)
+    return r
+
+
+def _start(fn, *args) -> Future:
+    """在独立线程上立即执行 (不经线程池排队)，返回其 Future"""
+    fut = Future()
+    def run():
+        try: fut.set_result(fn(*args))
+        except BaseException as e: fut.set_exception(e)
+    threading.Thread(target=run, name="em-primary", daemon=True).start()
+    return fut
+
+
+def request(endpoint, url, params=None, timeout=1.0, hedge=False) -> requests.Response:
+    """
+    带自适应超时的 GET。hedge=True 时，主请求超过 p95 延迟仍未返回 (或已失败) 就再发一份，
+    两者谁先成功用谁。主请求在独立线程上立即发出，对冲计时从发出时开始；
+    只有对冲请求进共享线程池，调用方并发再高，主请求也不会排在别人的请求后面。
+    """
+    limit = adaptive_timeout(endpoint, timeout)
+    if not hedge: return _timed_get(endpoint, url, params, limit)
+
+    global _hedge_pool
+    with _session_lock:
+        if _hedge_pool is None: _hedge_pool = ThreadPoolExecutor(HEDGE_WORKERS, thread_name_prefix="em-hedge")
+    futures = [_start(_timed_get, endpoint, url, params, limit)]
+    done, _ = wait(futures, timeout=hedge_delay(endpoint, timeout))
+    if not done or futures[0].exception() is not None:
+        futures.append(_hedge_pool.submit(_timed_get, endpoint, url, params, limit))
+    error = None
+    for fut in as_completed(futures):
+        try: return fut.result()
+        except Exception as e: error = e
+    raise error
+
+
+class SingleFlight:
+    """同一 key 的并发调用只执行一次：首个调用者发请求，其余等待并拿到同一结果 (或同一异常)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            fut = self.calls.get(key)
+            leader = fut is None
+            if leader: fut = self.calls[key] = Future()
+        if not leader: return fut.result()
+        try:
+            result = fn(*args, **kwargs)
+            fut.set_result(result)
+            return result
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self.lock: self.calls.pop(key, None)
+
+
+flights = SingleFlight()
+
+
+def fetch_estimate(code, timeout=1.0, hedge=False) -> Optional[dict]:
+    """
+    天天基金实时估值 (JSONP: jsonpgz({...});)。timeout 为冷启动超时，之后自适应。
+    返回原始字段 fundcode/name/jzrq/dwjz/gsz/gszzl/gztime，失败返回 None。
+    同一基金、同一对冲设置的并发请求合并为一次 (对冲的持仓请求不会挂到不对冲的请求上)，
+    返回的 dict 为共享对象，调用方只读。
+    """
+    return flights.do(("estimate", code, hedge), _fetch_estimate, code, timeout, hedge)
+
+
+def _fetch_estimate(code, timeout, hedge):
+    try:
+        r = request("estimate", ESTIMATE_URL.format(code=code), params={"rt": int(time.time() * 1000)}, timeout=timeout, hedge=hedge)
+        if r.status_code != 200: return None
+        match = re.findall(r'\((.*?)\)', r.text)
+        return json.loads(match[0]) if match else None
+    except Exception:
+        return None
+
+
+class TokenBucket:
+    """令牌桶 + AIMD：成功时线性提速 (不超过基准的 RATE_CEIL_MULT 倍)，失败时减半并清空余量"""
+
+    def __init__(self, rate):
+        self.base = self.rate = rate
+        self.tokens = rate * AK_BURST_SECONDS
+        self.stamp = time.monotonic()
+
+    def delay(self) -> float:
+        """距离下一枚令牌的秒数，0 表示可立即取"""
+        now = time.monotonic()
+        self.tokens = min(self.rate * AK_BURST_SECONDS, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def feedback(self, ok):
+        if ok:
+            self.rate = min(self.base * RATE_CEIL_MULT, self.rate + RATE_STEP)
+        else:
+            self.rate = max(RATE_FLOOR, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+
+class RequestScheduler:
+    """
+    进程级 akshare 调度器。每个接口一个令牌桶，等待者按 (车道, 公平标签, 到达序) 出队；
+    公平标签按会话累计 (起始时间公平排队)：同一车道里刚被服务过的会话排到其他会话之后。
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.buckets = {}
+        self.queues = {}
+        self.vtime = {}   # (接口, 车道) -> 最近出队的标签
+        self.tags = {}    # (接口, 车道, 会话) -> 该会话最近一次的标签
+        self.seq = itertools.count()
+
+    def acquire(self, endpoint, lane=DEFAULT_LANE, client=None):
+        """阻塞直到轮到本请求且桶里有令牌"""
+        with self.cond:
+            bucket = self.buckets.get(endpoint)
+            if bucket is None:
+                bucket = self.buckets[endpoint] = TokenBucket(AK_RATES.get(endpoint, AK_DEFAULT_RATE))
+            queue = self.queues.setdefault(endpoint, [])
+            tag = max(self.vtime.get((endpoint, lane), 0), self.tags.get((endpoint, lane, client), 0)) + 1
+            self.tags[(endpoint, lane, client)] = tag
+            entry = (LANES.get(lane, LANES[DEFAULT_LANE]), tag, next(self.seq))
+            heapq.heappush(queue, entry)
+            while True:
+                if queue[0] is entry:
+                    wait_s = bucket.delay()
+                    if wait_s <= 0:
+                        heapq.heappop(queue)
+                        bucket.take()
+                        self.vtime[(endpoint, lane)] = tag
+                        self.cond.notify_all()
+                        return
+                    self.cond.wait(wait_s)
+                else:
+                    self.cond.wait()
+
+    def report(self, endpoint, ok):
+        with self.cond:
+            self.buckets[endpoint].feedback(ok)
+
+
+scheduler = RequestScheduler()
+_context = threading.local()
+
+
+@contextmanager
+def lane(name=None, client=None):
+    """指定当前线程后续 akshare 请求的车道 / 会话；传 None 的一项沿用外层设置"""
+    prev = (current_lane(), current_client())
+    _context.lane = name or prev[0]
+    _context.client = client if client is not None else prev[1]
+    try:
+        yield
+    finally:
+        _context.lane, _context.client = prev
+
+
+def current_lane():
+    return getattr(_context, "lane", DEFAULT_LANE)
+
+
+def current_client():
+    return getattr(_context, "client", None)
+
+
+def streamlit_session_id():
+    """当前 Streamlit 会话 ID (调度器据此在会话间公平排队)；不在脚本线程中时返回 None"""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        return ctx.session_id if ctx else None
+    except Exception:
+        return None
+
+
+def ak_call(fn, *args, **kwargs):
+    """
+    经调度器调用 akshare 接口 (fn 为 ak.xxx)；异常照常抛出，同时计入该接口的限速反馈。
+    同一车道内相同参数的并发调用合并为一次，返回的 DataFrame 为共享对象，调用方不要原地修改。
+    车道计入合并键：高优先级请求不会挂到低车道 (如后台预热) 的在途请求上排队。
+    """
+    key = (fn.__name__, current_lane(), args, tuple(sorted(kwargs.items())))
+    return flights.do(key, _scheduled_call, fn, *args, **kwargs)
+
+
+def _scheduled_call(fn, *args, **kwargs):
+    endpoint = fn.__name__
+    scheduler.acquire(endpoint, current_lane(), current_client())
+    try:
+        result = fn(*args, **kwargs)
+    except Exception:
+        scheduler.report(endpoint, False)
+        raise
+    # 空结果 (新基金、非交易日等) 也算成功，只有异常才触发降速
+    scheduler.report(endpoint, True)
+    return result
@@ -8,7 +8,10 @@ import time
 import json
 import os
 import re
-import requests
+import em_transport
+import nav_panel
+from zigzag import ZigZagTracker
+from indicators import compute_indicators
 from dataclasses import dataclass, field, asdict
 from typing import List, Dict, Optional
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -189,52 +192,17 @@ class IndicatorEngine:
     @staticmethod
     def calculate_indicators(df: pd.DataFrame) -> pd.DataFrame:
         if df.empty: return df
-        data = df.copy()
-        
-        # 基础均线
-        data['ema_21'] = data['nav'].ewm(span=21, adjust=False).mean() 
-        data['ema_55'] = data['nav'].ewm(span=55, adjust=False).mean() 
-        data['ema_89'] = data['nav'].ewm(span=89, adjust=False).mean() 
-        data['ema_144'] = data['nav'].ewm(span=144, adjust=False).mean()
-        
-        # 唐奇安通道
-        data['high_20'] = data['nav'].rolling(window=20).max()
-        data['low_20'] = data['nav'].rolling(window=20).min()
-        
-        # MACD
-        exp12 = data['nav'].ewm(span=12, adjust=False).mean()
-        exp26 = data['nav'].ewm(span=26, adjust=False).mean()
-        data['macd'] = exp12 - exp26
-        data['signal'] = data['macd'].ewm(span=9, adjust=False).mean()
-        data['hist'] = data['macd'] - data['signal']
-        
-        # RSI
-        delta = data['nav'].diff()
-        gain = (delta.where(delta > 0, 0)).rolling(window=14).mean()
-        loss = (-delta.where(delta < 0, 0)).rolling(window=14).mean()
-        rs = gain / loss
-        data['rsi'] = 100 - (100 / (1 + rs))
-        data['rsi_prev'] = data['rsi'].shift(1)
-        
-        # ATR
-        data['tr'] = data['nav'].diff().abs()
-        data['atr'] = data['tr'].rolling(window=14).mean()
-        
-        # AO Indicator
-        data['ao'] = data['nav'].rolling(window=5).mean() - data['nav'].rolling(window=34).mean()
-        data['ao_prev'] = data['ao'].shift(1)
-        
-        # Return for Correlation
-        data['pct_change'] = data['nav'].pct_change()
-        
-        return data
+        return compute_indicators(df)
 
 class DataService:
     @staticmethod
     @st.cache_data(ttl=3600)
     def fetch_nav_history(code):
+        # 本地净值面板足够新时直接映射读取，免去网络请求
+        cached = nav_panel.lookup(code, nav_panel.required_nav_date(get_bj_time()))
+        if cached is not None: return cached
         try:
-            df = ak.fund_open_fund_info_em(symbol=code, indicator="单位净值走势")
+            df = em_transport.ak_call(ak.fund_open_fund_info_em, symbol=code, indicator="单位净值走势")
             if df.empty: return pd.DataFrame()
             df = df.rename(columns={"净值日期": "date", "单位净值": "nav"})
             df['date'] = pd.to_datetime(df['date'])
@@ -259,25 +227,18 @@ class DataService:
         except: return 0 
 
     @staticmethod
-    def get_realtime_estimate(code):
-        try:
-            ts = int(time.time() * 1000)
-            url = f"http://fundgz.1234567.com.cn/js/{code}.js?rt={ts}"
-            r = requests.get(url, timeout=1)
-            if r.status_code == 200:
-                txt = r.text
-                match = re.findall(r'\((.*?)\)', txt)
-                if match:
-                    json_str = match[0]
-                    data = json.loads(json_str)
-                    return float(data['gsz']), float(data['gszzl']), data['gztime']
-            return None, None, None
+    def get_realtime_estimate(code, hedge=False):
+        """hedge=True 用于持仓：估值接口迟迟不回时补发一次对冲请求"""
+        data = em_transport.fetch_estimate(code, timeout=1, hedge=hedge)
+        if not data: return None, None, None
+        try: return float(data['gsz']), float(data['gszzl']), data['gztime']
         except: return None, None, None
     
     @staticmethod
-    def get_smart_price(code, cost_basis=0.0):
-        df = DataService.fetch_nav_history(code)
-        est_p, _, _ = DataService.get_realtime_estimate(code)
+    def get_smart_price(code, cost_basis=0.0, hedge=False):
+        with em_transport.lane("holdings" if hedge else None):
+            df = DataService.fetch_nav_history(code)
+        est_p, _, _ = DataService.get_realtime_estimate(code, hedge=hedge)
         
         curr_price = cost_basis 
         today_str = get_bj_time().date().strftime("%Y-%m-%d")
@@ -361,7 +322,7 @@ class DataService:
     @st.cache_data(ttl=3600*24)
     def get_market_wide_pool():
         try:
-            df = ak.fund_open_fund_rank_em(symbol="全部")
+            df = em_transport.ak_call(ak.fund_open_fund_rank_em, symbol="全部")
             mask_type = df['基金简称'].str.contains('债|货币|理财|美元|定开|持有|养老|以太|比特币|港股|QDII', regex=True) == False
             df = df[mask_type]
             df = df.dropna(subset=['近1年'])
@@ -399,25 +360,8 @@ class DataService:
 class WaveEngine:
     @staticmethod
     def zig_zag(series: pd.Series, deviation_pct=0.05) -> List[Dict]: 
-        pivots = [] 
         if len(series) < 10: return []
-        direction = 0; last_pivot_idx = 0; last_pivot_val = series.iloc[0]
-        dates = series.index
-        pivots.append({'idx': 0, 'date': dates[0], 'val': last_pivot_val, 'type': 'start'})
-        for i in range(1, len(series)):
-            curr_val = series.iloc[i]
-            change = (curr_val - last_pivot_val) / last_pivot_val
-            if direction == 0:
-                if change >= deviation_pct: direction = 1; last_pivot_idx = i; last_pivot_val = curr_val
-                elif change <= -deviation_pct: direction = -1; last_pivot_idx = i; last_pivot_val = curr_val
-            elif direction == 1:
-                if curr_val > last_pivot_val: last_pivot_idx = i; last_pivot_val = curr_val
-                elif change <= -deviation_pct: pivots.append({'idx': last_pivot_idx, 'date': dates[last_pivot_idx], 'val': last_pivot_val, 'type': 'high'}); direction = -1; last_pivot_idx = i; last_pivot_val = curr_val
-            elif direction == -1:
-                if curr_val < last_pivot_val: last_pivot_idx = i; last_pivot_val = curr_val
-                elif change >= deviation_pct: pivots.append({'idx': last_pivot_idx, 'date': dates[last_pivot_idx], 'val': last_pivot_val, 'type': 'low'}); direction = 1; last_pivot_idx = i; last_pivot_val = curr_val
-        pivots.append({'idx': last_pivot_idx, 'date': dates[last_pivot_idx], 'val': last_pivot_val, 'type': 'high' if direction==1 else 'low'})
-        return pivots
+        return ZigZagTracker.from_series(series, deviation_pct).pivots()
 
     @staticmethod
     def analyze_structure(df_slice: pd.DataFrame, pivots: List[Dict]) -> Dict:
@@ -474,10 +418,11 @@ class WaveEngine:
 
         # === 策略 C: 逃顶 ===
         if len(df_slice) > 60:
-            price_window = df_slice['nav'].iloc[-60:]
-            if last_nav >= price_window.max() * 0.99:
-                ao_window = df_slice['ao'].iloc[-60:]
-                if ao_curr < ao_window.max() * 0.7: 
+            # 优先读预计算的滚动高点列 (回测逐日调用时不再重复扫描窗口)
+            price_high = df_slice['high_60'].iloc[-1] if 'high_60' in df_slice else df_slice['nav'].iloc[-60:].max()
+            if last_nav >= price_high * 0.99:
+                ao_high = df_slice['ao_high_60'].iloc[-1] if 'ao_high_60' in df_slice else df_slice['ao'].iloc[-60:].max()
+                if ao_curr < ao_high * 0.7: 
                      result.update({
                         'status': 'Sell', 
                         'score': -95, 
@@ -608,9 +553,11 @@ class PortfolioBacktester:
         total = len(codes_to_load)
         
         # 2. 定义单个下载任务函数
+        client = em_transport.current_client()
         def load_single_fund(fund_info):
-            # 获取数据并计算指标
-            df = DataService.fetch_nav_history(fund_info['code'])
+            # 获取数据并计算指标 (回测车道，让位于持仓与扫描请求)
+            with em_transport.lane("backtest", client):
+                df = DataService.fetch_nav_history(fund_info['code'])
             if not df.empty:
                 return fund_info['code'], IndicatorEngine.calculate_indicators(df)
             return fund_info['code'], None
@@ -630,6 +577,13 @@ class PortfolioBacktester:
                 completed_count += 1
                 progress_bar.progress(completed_count / total)
         
+        # 4. 新下载的历史写回本地净值面板，下次冷启动直接映射读取
+        required = nav_panel.required_nav_date(get_bj_time())
+        stale = {c: d[['nav']] for c, d in self.data_map.items() if not nav_panel.is_fresh(c, required)}
+        if stale:
+            try: nav_panel.merge(stale)
+            except OSError: pass
+        
         progress_text.empty()
         progress_bar.empty()
 
@@ -1240,7 +1194,7 @@ class PortfolioManager:
         
         for h in self.data['holdings']:
             # 获取最新价格
-            curr_p, _, _ = DataService.get_smart_price(h['code'], h['cost'])
+            curr_p, _, _ = DataService.get_smart_price(h['code'], h['cost'], hedge=True)
             
             # 计算最早买入日期
             first_buy = today_dt
@@ -1313,7 +1267,7 @@ def render_dashboard():
         alerts = []
         # 使用缓存的行情数据，避免重复请求
         for h in pm.data['holdings']:
-            curr_p, _, _ = DataService.get_smart_price(h['code'], h['cost'])
+            curr_p, _, _ = DataService.get_smart_price(h['code'], h['cost'], hedge=True)
             
             # 止损/止盈检查
             if h.get('stop_loss', 0) > 0 and curr_p < h['stop_loss']:
@@ -1568,7 +1522,7 @@ def render_dashboard():
         if st.button("刷新诊断"): st.rerun()
         for i, item in enumerate(USER_PORTFOLIO_CONFIG):
             # 使用智能价格获取
-            curr_price, df, used_est = DataService.get_smart_price(item['code'], item['cost'])
+            curr_price, df, used_est = DataService.get_smart_price(item['code'], item['cost'], hedge=True)
             
             # 如果使用了实时估值，需要模拟一行数据给指标引擎
             if used_est and not df.empty:
@@ -1618,7 +1572,7 @@ def render_dashboard():
             with st.spinner(f"正在扫描 {len(holdings)} 个持仓的实时风险..."):
                 for h in holdings:
                     # 使用智能价格获取
-                    curr_price, df, used_est = DataService.get_smart_price(h['code'], h['cost'])
+                    curr_price, df, used_est = DataService.get_smart_price(h['code'], h['cost'], hedge=True)
                     
                     if not df.empty:
                         if used_est:
@@ -1749,7 +1703,7 @@ def render_dashboard():
         # === 顶部资产数据卡片: 价格修正 ===
         total_hold_val = 0
         for h in holdings:
-            curr_p, _, _ = DataService.get_smart_price(h['code'], h['cost'])
+            curr_p, _, _ = DataService.get_smart_price(h['code'], h['cost'], hedge=True)
             total_hold_val += h['shares'] * curr_p
 
         pending_val = sum([p['amount'] for p in pending])
@@ -1767,7 +1721,7 @@ def render_dashboard():
             st.subheader("📊 资产状态")
             hold_vals = []
             for h in holdings:
-                curr_p, _, _ = DataService.get_smart_price(h['code'], h['cost'])
+                curr_p, _, _ = DataService.get_smart_price(h['code'], h['cost'], hedge=True)
                 hold_vals.append(h['shares'] * curr_p)
 
             labels = ['现金', '在途'] + [h['name'] for h in holdings]
@@ -1812,7 +1766,7 @@ def render_dashboard():
             else:
                 for h in holdings:
                     # 使用智能价格获取
-                    curr_price, df, used_est = DataService.get_smart_price(h['code'], h['cost'])
+                    curr_price, df, used_est = DataService.get_smart_price(h['code'], h['cost'], hedge=True)
                     
                     can_add = False; add_reason = ""
                     res = {'status': 'Unknown', 'desc': '', 'score': 0}
@@ -2129,4 +2083,5 @@ def render_dashboard():
                     st.download_button("📥 导出回测记录 (CSV)", data=csv_bt, file_name="backtest_trades.csv", mime="text/csv")
 
 if __name__ == "__main__":
-    render_dashboard()
\ No newline at end of file
+    with em_transport.lane(client=em_transport.streamlit_session_id()):
+        render_dashboard()
\ No newline at end of file
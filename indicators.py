@@ -0,0 +1,76 @@
+"""
+技术指标的列定义与按需计算 (streamlit_app / ew_fund_quant / bot_cron 共用同一份注册表)。
+各入口的 IndicatorEngine 只决定默认产出哪些列。
+"""
+from typing import Sequence
+
+import pandas as pd
+
+import rolling_extrema
+
+
+class LazyIndicators:
+    """
+    按需计算的指标表：列在首次访问时计算并缓存，依赖自动解析 (如 hist -> macd/signal -> ema_12/ema_26)。
+    只读少数几列的调用方 (大盘趋势、市场温度、bot 巡检) 只为用到的列付费。
+    """
+    # 列名 -> (依赖列, 计算函数)；计算函数只读取已解析好的依赖列
+    SPECS = {
+        'ema_12': (('nav',), lambda c: c['nav'].ewm(span=12, adjust=False).mean()),
+        'ema_21': (('nav',), lambda c: c['nav'].ewm(span=21, adjust=False).mean()),
+        'ema_26': (('nav',), lambda c: c['nav'].ewm(span=26, adjust=False).mean()),
+        'ema_55': (('nav',), lambda c: c['nav'].ewm(span=55, adjust=False).mean()),
+        'ema_89': (('nav',), lambda c: c['nav'].ewm(span=89, adjust=False).mean()),
+        'ema_144': (('nav',), lambda c: c['nav'].ewm(span=144, adjust=False).mean()),
+        # 唐奇安通道
+        'high_20': (('nav',), lambda c: rolling_extrema.rolling_max(c['nav'], 20)),
+        'low_20': (('nav',), lambda c: rolling_extrema.rolling_min(c['nav'], 20)),
+        # 策略 C 的 60 日价格 / 动能高点 (跳过 NaN，与 iloc[-60:].max() 一致)
+        'high_60': (('nav',), lambda c: rolling_extrema.rolling_max(c['nav'], 60, min_periods=1)),
+        'ao_high_60': (('ao',), lambda c: rolling_extrema.rolling_max(c['ao'], 60, min_periods=1)),
+        # MACD
+        'macd': (('ema_12', 'ema_26'), lambda c: c['ema_12'] - c['ema_26']),
+        'signal': (('macd',), lambda c: c['macd'].ewm(span=9, adjust=False).mean()),
+        'hist': (('macd', 'signal'), lambda c: c['macd'] - c['signal']),
+        # RSI
+        'delta': (('nav',), lambda c: c['nav'].diff()),
+        'gain': (('delta',), lambda c: (c['delta'].where(c['delta'] > 0, 0)).rolling(window=14).mean()),
+        'loss': (('delta',), lambda c: (-c['delta'].where(c['delta'] < 0, 0)).rolling(window=14).mean()),
+        'rsi': (('gain', 'loss'), lambda c: 100 - (100 / (1 + c['gain'] / c['loss']))),
+        'rsi_prev': (('rsi',), lambda c: c['rsi'].shift(1)),
+        # ATR
+        'tr': (('delta',), lambda c: c['delta'].abs()),
+        'atr': (('tr',), lambda c: c['tr'].rolling(window=14).mean()),
+        # AO Indicator
+        'ao': (('nav',), lambda c: c['nav'].rolling(window=5).mean() - c['nav'].rolling(window=34).mean()),
+        'ao_prev': (('ao',), lambda c: c['ao'].shift(1)),
+        # Return for Correlation
+        'pct_change': (('nav',), lambda c: c['nav'].pct_change()),
+    }
+
+    def __init__(self, df: pd.DataFrame):
+        self.cols = {'nav': df['nav']}
+
+    def __getitem__(self, name) -> pd.Series:
+        col = self.cols.get(name)
+        if col is None:
+            deps, fn = self.SPECS[name]
+            for dep in deps: self[dep]
+            col = self.cols[name] = fn(self.cols)
+        return col
+
+    def __contains__(self, name):
+        return name == 'nav' or name in self.SPECS
+
+# calculate_indicators 默认产出的列 (顺序即 DataFrame 列序)
+INDICATOR_COLUMNS = ['ema_21', 'ema_55', 'ema_89', 'ema_144', 'high_20', 'low_20', 'macd', 'signal', 'hist',
+                     'rsi', 'rsi_prev', 'tr', 'atr', 'ao', 'ao_prev', 'pct_change', 'high_60', 'ao_high_60']
+
+
+def compute_indicators(df: pd.DataFrame, columns: Sequence[str] = INDICATOR_COLUMNS) -> pd.DataFrame:
+    """df 的副本追加 columns 指定的指标列 (只计算这些列及其依赖)"""
+    lazy = LazyIndicators(df)
+    data = df.copy()
+    for col in columns:
+        if col != 'nav': data[col] = lazy[col]
+    return data
@@ -0,0 +1,200 @@
+"""
+基金净值面板文件 (内存映射，只读打开)。
+
+单文件布局，打开时不做任何解析，np.memmap 直接映射：
+    [8B 魔数][4B 头长度][头 JSON][填充至 64B 对齐]
+    [int32 天序号 × n_days]       自 1970-01-01 起的天数，升序 (全部基金日期的并集)
+    [int32 最后有效天序号 × n_codes]
+    [float32 净值 × n_codes × n_days]  按基金行存储，单只基金的历史连续；无净值的日子为 NaN
+头 JSON 只含代码字典与各段偏移。
+
+streamlit_app / ew_fund_quant / bot_cron / rt_earn 的 fetch_nav_history 先查面板 (足够新才用)，
+回测预载与夜间任务把下载到的历史写回面板，冷启动时不必再走网络。
+"""
+import datetime
+import json
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+try:
+    import fcntl  # 跨进程写锁 (POSIX)；没有时只做进程内互斥
+except ImportError:
+    fcntl = None
+
+import numpy as np
+import pandas as pd
+
+NAV_PANEL_PATH = os.environ.get("NAV_PANEL_PATH", "nav_panel.bin")
+MAGIC = b"NAVPANL1"
+ALIGN = 64
+NAV_DECIMALS = 4  # 单位净值公布到 4 位小数，float32 读回后按此还原
+NAV_PUBLISH_HOUR = 21  # 官方净值大多在此之前发布 (北京时间)
+
+_cache = {}  # path -> (mtime_ns, NavPanel)
+_lock = threading.Lock()
+_write_lock = threading.Lock()  # merge 的读-改-写整体互斥 (与 _lock 分开，写盘期间不挡读者)
+_calendar = None  # (交易日集合, 首日, 末日)；未装入时按工作日近似
+
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+class NavPanel:
+    """已映射的面板：codes / days / last / nav 均为只读视图"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if f.read(8) != MAGIC: raise ValueError(f"{path} 不是净值面板文件")
+            (head_len,) = struct.unpack("<I", f.read(4))
+            head = json.loads(f.read(head_len))
+        n_codes, n_days = len(head["codes"]), head["n_days"]
+        self.path = path
+        self.codes = head["codes"]
+        self.index = {c: i for i, c in enumerate(self.codes)}
+        self.days = np.memmap(path, np.int32, "r", head["days_offset"], (n_days,)) if n_days else np.zeros(0, np.int32)
+        self.last = np.memmap(path, np.int32, "r", head["last_offset"], (n_codes,)) if n_codes else np.zeros(0, np.int32)
+        self.nav = np.memmap(path, np.float32, "r", head["nav_offset"], (n_codes, n_days)) if n_codes and n_days else np.zeros((n_codes, n_days), np.float32)
+
+    def __contains__(self, code):
+        return code in self.index
+
+    def last_date(self, code) -> Optional[str]:
+        i = self.index.get(code)
+        return None if i is None else str(np.datetime64(int(self.last[i]), "D"))
+
+    def frame(self, code) -> pd.DataFrame:
+        """与 fetch_nav_history 相同形状的 DataFrame (date 索引 + float64 nav 列，数值与接口原值一致)"""
+        i = self.index.get(code)
+        if i is None: return pd.DataFrame()
+        row = self.nav[i]
+        mask = ~np.isnan(row)
+        dates = pd.DatetimeIndex(self.days[mask].astype("datetime64[D]"), name="date")
+        return pd.DataFrame({"nav": np.round(row[mask].astype(float), NAV_DECIMALS)}, index=dates)
+
+    def matrix(self, codes):
+        """多只基金对齐到同一日期轴：(DatetimeIndex, float32 [len(codes), n_days])，不在面板中的行全为 NaN"""
+        out = np.full((len(codes), len(self.days)), np.nan, dtype=np.float32)
+        for k, code in enumerate(codes):
+            i = self.index.get(code)
+            if i is not None: out[k] = self.nav[i]
+        return pd.DatetimeIndex(self.days.astype("datetime64[D]"), name="date"), out
+
+
+def write(path, frames: Dict[str, pd.DataFrame]):
+    """把 {code: 净值 DataFrame} 写成面板 (临时文件 + os.replace，读者手里的旧映射不受影响)"""
+    frames = {c: df for c, df in frames.items() if df is not None and not df.empty}
+    day_of = {c: df.index.values.astype("datetime64[D]").astype(np.int64) for c, df in frames.items()}
+    days = np.unique(np.concatenate(list(day_of.values()))) if day_of else np.zeros(0, np.int64)
+    codes = list(frames)
+    nav = np.full((len(codes), len(days)), np.nan, dtype=np.float32)
+    last = np.zeros(len(codes), dtype=np.int32)
+    for i, code in enumerate(codes):
+        pos = np.searchsorted(days, day_of[code])
+        nav[i, pos] = frames[code]["nav"].to_numpy(dtype=np.float32)
+        last[i] = day_of[code].max()
+
+    head = {"codes": codes, "n_days": int(len(days))}
+    # 先按占位偏移估算头长度，再定下真实偏移 (偏移位数变化不超过对齐余量)
+    probe = json.dumps({**head, "days_offset": 10 ** 12, "last_offset": 10 ** 12, "nav_offset": 10 ** 12}).encode()
+    days_offset = _aligned(12 + len(probe))
+    last_offset = _aligned(days_offset + 4 * len(days))
+    nav_offset = _aligned(last_offset + 4 * len(codes))
+    raw = json.dumps({**head, "days_offset": days_offset, "last_offset": last_offset, "nav_offset": nav_offset}).encode()
+
+    tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(raw)) + raw)
+        for offset, arr in ((days_offset, days.astype(np.int32)), (last_offset, last), (nav_offset, nav)):
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(arr.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def open_panel(path=NAV_PANEL_PATH) -> Optional[NavPanel]:
+    """打开 (或复用已打开的) 面板；文件被替换后自动重新映射，不存在或损坏时返回 None"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    with _lock:
+        cached = _cache.get(path)
+        if cached and cached[0] == mtime: return cached[1]
+        try:
+            panel = NavPanel(path)
+        except Exception:
+            return None
+        _cache[path] = (mtime, panel)
+        return panel
+
+
+def is_fresh(code, min_date, path=NAV_PANEL_PATH) -> bool:
+    """面板中该基金的最后净值日期不早于 min_date (YYYY-MM-DD)"""
+    panel = open_panel(path)
+    return panel is not None and code in panel and panel.last_date(code) >= min_date
+
+
+def lookup(code, min_date, path=NAV_PANEL_PATH) -> Optional[pd.DataFrame]:
+    """面板足够新时返回该基金的历史，否则 None (调用方走网络)"""
+    return open_panel(path).frame(code) if is_fresh(code, min_date, path) else None
+
+
+@contextmanager
+def _exclusive(path):
+    """同一面板的写者互斥：进程内线程锁 + 旁路 .lock 文件的 flock (多个进程写同一文件时)"""
+    with _write_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(f"{path}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try: yield
+            finally: fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def merge(frames: Dict[str, pd.DataFrame], path=NAV_PANEL_PATH):
+    """
+    把新下载的历史并入面板 (同代码以新数据为准)，整体重写。
+    读旧面板到替换文件整段持锁，并发的 merge 依次叠加，不会互相丢掉对方写入的基金。
+    """
+    with _exclusive(path):
+        panel = open_panel(path)
+        merged = {c: panel.frame(c) for c in panel.codes if c not in frames} if panel else {}
+        merged.update(frames)
+        write(path, merged)
+
+
+def set_trading_calendar(days):
+    """装入交易所交易日历 (日期或 YYYY-MM-DD 字符串的序列)；空序列表示清除，回到工作日近似"""
+    global _calendar
+    dates = sorted(pd.to_datetime(pd.Series(list(days), dtype=object)).dt.date) if len(days) else []
+    _calendar = (frozenset(dates), dates[0], dates[-1]) if dates else None
+
+
+def is_trading_day(day) -> bool:
+    """日历覆盖范围内按日历判断 (含节假日)，范围外或未装入日历时按工作日近似"""
+    cal = _calendar
+    if cal and cal[1] <= day <= cal[2]: return day in cal[0]
+    return day.weekday() < 5
+
+
+def previous_trading_day(day) -> datetime.date:
+    """day 之前最近的交易日"""
+    day -= datetime.timedelta(days=1)
+    while not is_trading_day(day): day -= datetime.timedelta(days=1)
+    return day
+
+
+def required_nav_date(now) -> str:
+    """
+    面板算"足够新"所需的最后净值日期 (北京时间 now)：交易日晚间官方净值发布后要求当天，
+    否则要求之前最近的交易日。
+    """
+    day = now.date()
+    if is_trading_day(day) and now.hour >= NAV_PUBLISH_HOUR: return str(day)
+    return str(previous_trading_day(day))
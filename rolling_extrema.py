@@ -0,0 +1,46 @@
+"""
+滚动极值 (最大 / 最小) 内核。
+
+唐奇安通道 (high_20 / low_20)、策略 C 的 60 日价格 / AO 高点都是同一种计算，这里统一实现：
+rolling_max / rolling_min 对整段序列一次线性扫描 (van Herk / Gil-Werman 分块前后缀极值，numpy 向量化)，
+NaN 语义与 pandas rolling(window, min_periods).max()/min() 一致。
+"""
+import numpy as np
+import pandas as pd
+
+
+def _rolling(values, window, min_periods, reduce):
+    x = np.asarray(values, dtype=float)
+    n = len(x)
+    min_periods = window if min_periods is None else min_periods
+    out = np.full(n, np.nan)
+    if n == 0 or window < 1: return out
+
+    # 补齐到 window 的整数倍后分块：块内前缀极值 P、后缀极值 S
+    pad = -n % window
+    blocks = np.concatenate([x, np.full(pad, np.nan)]).reshape(-1, window)
+    prefix = reduce.accumulate(blocks, axis=1).ravel()[:n]
+    suffix = reduce.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()[:n]
+    # 窗口 [i-w+1, i] 至多跨两块：极值 = S[i-w+1] 与 P[i] 的较优者；不足一个窗口的开头即块 0 的前缀
+    if n >= window: out[window - 1:] = reduce(suffix[:n - window + 1], prefix[window - 1:])
+    out[:window - 1] = prefix[:window - 1]
+
+    # 窗口内有效值个数不足 min_periods 的位置置 NaN
+    valid = np.concatenate([[0], np.cumsum(~np.isnan(x))])
+    count = valid[1:] - valid[np.maximum(np.arange(1, n + 1) - window, 0)]
+    out[count < max(min_periods, 1)] = np.nan
+    return out
+
+
+def _wrap(values, out):
+    return pd.Series(out, index=values.index, name=values.name) if isinstance(values, pd.Series) else out
+
+
+def rolling_max(values, window, min_periods=None):
+    """等价于 pd.Series(values).rolling(window, min_periods).max()；传入 Series 返回同索引的 Series，否则 float64 数组"""
+    return _wrap(values, _rolling(values, window, min_periods, np.fmax))
+
+
+def rolling_min(values, window, min_periods=None):
+    return _wrap(values, _rolling(values, window, min_periods, np.fmin))
+
@@ -9,13 +9,19 @@ import json
 import os
 import re
 import requests
+import em_transport
+import nav_panel
+from zigzag import ZigZagTracker
+from indicators import LazyIndicators, INDICATOR_COLUMNS, compute_indicators
 import pytz
+import threading
 import smtplib
 import datetime
 from email.mime.text import MIMEText
 from email.header import Header
 from dataclasses import dataclass, field, asdict
 from typing import List, Dict, Optional
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from st_supabase_connection import SupabaseConnection
 
@@ -63,6 +69,23 @@ MAX_SINGLE_POS_WEIGHT = 0.20
 DEAD_MONEY_DAYS = 40 
 DEAD_MONEY_THRESHOLD = 0.03 
 
+# 紧凑指标表 (可选)：float32 且只保留下游实际读取的列，回测预载的内存约降到原来的 1/4
+COMPACT_INDICATORS = os.environ.get("EW_COMPACT_INDICATORS", "0") == "1"
+COMPACT_COLUMNS = ['nav', 'ema_21', 'ema_55', 'ema_89', 'ema_144', 'high_20', 'low_20', 'rsi', 'atr', 'ao',
+                   'high_60', 'ao_high_60']
+
+# 拐点索引缓存上限 (按最近使用淘汰)
+PIVOT_CACHE_MAX = 256
+# 图表"波段尺度"滑块的说明：非 5% 尺度是全历史拐点，与诊断切片不同源
+SCALE_HELP = "5% 为诊断信号所用的拐点 (近 150 根净值)；其他尺度取自全历史拐点索引，窗口开头的拐点可能与诊断不一致"
+
+# 相关性：收益窗口 (净值日) 与一对基金至少需要的共同样本数
+CORR_WINDOW = 250
+CORR_MIN_OBS = 20
+
+# 缓存预热时刻 (北京时间，仅交易日)：官方净值发布后、开盘前
+WARM_SCHEDULE = ((nav_panel.NAV_PUBLISH_HOUR, 30), (9, 0))
+
 # 费率设置 (模拟C类)
 FEE_C_CLASS = {'buy': 0.0, 'sell_punish': 0.015, 'sell_normal': 0.0}
 
@@ -219,33 +242,114 @@ def get_pool_by_strategy(strategy_name: str) -> List[Dict]:
 
 # === 数据结构 ===
 
-@dataclass
+@dataclass(slots=True)
 class TaxLot:
     date: str
     shares: float
     cost_per_share: float
     fee_paid: float = 0.0
 
-@dataclass
+def _lot_day(date_str):
+    """批次日期 -> datetime64[D]，无法解析时返回 NaT (不计惩罚费)"""
+    try:
+        return np.datetime64(str(date_str).split(' ')[0], 'D')
+    except ValueError:
+        return np.datetime64('NaT', 'D')
+
+class LotBook:
+    """
+    持仓批次簿：按买入日期先后排列 (FIFO)，份额/成本/费用以数组存放，
+    整批估值与先进先出扣减都可以向量化完成。
+    """
+    __slots__ = ('dates', 'days', 'shares', 'costs', 'fees')
+
+    def __init__(self, dates=(), shares=(), costs=(), fees=None):
+        self.dates = np.array(list(dates), dtype=object)
+        self.days = np.array([_lot_day(d) for d in self.dates], dtype='datetime64[D]')
+        self.shares = np.asarray(shares, dtype=float)
+        self.costs = np.asarray(costs, dtype=float)
+        self.fees = np.zeros(len(self.shares)) if fees is None else np.asarray(fees, dtype=float)
+
+    @classmethod
+    def from_records(cls, records: List[Dict]) -> "LotBook":
+        records = sorted(records, key=lambda x: str(x.get('date', '')))
+        return cls(
+            [r.get('date', "2020-01-01") for r in records],
+            [r.get('shares', 0.0) for r in records],
+            [r.get('cost_per_share', 0.0) for r in records],
+            [r.get('fee_paid', 0.0) for r in records],
+        )
+
+    def to_records(self) -> List[Dict]:
+        records = []
+        for d, s, c, f in zip(self.dates, self.shares, self.costs, self.fees):
+            lot = {"date": d, "shares": float(s), "cost_per_share": float(c)}
+            if f: lot["fee_paid"] = float(f)
+            records.append(lot)
+        return records
+
+    def __len__(self): return len(self.shares)
+    def __getitem__(self, i): return TaxLot(self.dates[i], float(self.shares[i]), float(self.costs[i]), float(self.fees[i]))
+    def __iter__(self): return (self[i] for i in range(len(self)))
+
+    @property
+    def total_shares(self): return float(self.shares.sum())
+    @property
+    def cost_basis(self): return float(self.shares @ self.costs)
+
+    def append(self, date, shares, cost_per_share, fee_paid=0.0):
+        """插入新批次，保持按日期排序"""
+        pos = int(np.searchsorted(self.dates.astype(str), str(date), side='right'))
+        self.dates = np.insert(self.dates, pos, date)
+        self.days = np.insert(self.days, pos, _lot_day(date))
+        self.shares = np.insert(self.shares, pos, float(shares))
+        self.costs = np.insert(self.costs, pos, float(cost_per_share))
+        self.fees = np.insert(self.fees, pos, float(fee_paid))
+
+    def hold_days(self, today) -> np.ndarray:
+        """各批次持有天数 (NaT 批次为 nan)"""
+        return (np.datetime64(today, 'D') - self.days) / np.timedelta64(1, 'D')
+
+    def fifo_take(self, qty) -> np.ndarray:
+        """按先进先出计算卖出 qty 份时每个批次被扣减的份额 (不修改批次)"""
+        ahead = np.cumsum(self.shares) - self.shares
+        return np.clip(qty - ahead, 0.0, self.shares)
+
+    def consume(self, taken: np.ndarray):
+        """扣减已卖出份额，卖空的批次直接移除"""
+        keep = np.abs(taken - self.shares) >= 1e-6
+        self.dates = self.dates[keep]
+        self.days = self.days[keep]
+        self.shares = (self.shares - taken)[keep]
+        self.costs = self.costs[keep]
+        self.fees = self.fees[keep]
+
+# Holding <-> 云端 JSON 字段映射之外的键原样保留在 extra 中
+_HOLDING_KEYS = {"code", "name", "shares", "cost", "date", "stop_loss", "target", "partial_sold",
+                 "lots", "highest_nav", "atr_at_entry", "wave_pattern"}
+
+@dataclass(slots=True)
 class Holding:
     code: str
     name: str
-    lots: List[TaxLot] = field(default_factory=list)
+    lots: LotBook = field(default_factory=LotBook)
     atr_at_entry: float = 0.0
     stop_loss_price: float = 0.0
     target_price: float = 0.0
     highest_nav: float = 0.0
     wave_pattern: str = "Unknown"
     partial_profit_taken: bool = False
+    entry_date: str = ""
+    extra: Dict = field(default_factory=dict)
     
     @property
-    def total_shares(self): return sum(lot.shares for lot in self.lots)
+    def total_shares(self): return self.lots.total_shares
     @property
-    def avg_cost(self): return sum(lot.shares * lot.cost_per_share for lot in self.lots) / self.total_shares if self.total_shares > 0 else 0
+    def avg_cost(self): return self.lots.cost_basis / self.total_shares if self.total_shares > 0 else 0
     def market_value(self, current_nav): return self.total_shares * current_nav
     
     def get_holding_days(self):
-        if not self.lots: return 0
+        if not len(self.lots): return 0
         try:
             buy_date_str = self.lots[0].date.split(' ')[0]
             buy_date = datetime.datetime.strptime(buy_date_str, "%Y-%m-%d").date()
@@ -253,58 +357,124 @@ class Holding:
         except:
             return 0
 
+    @classmethod
+    def from_dict(cls, d: Dict) -> "Holding":
+        """从云端 JSON 持仓记录构建 (无批次的旧数据按 2020-01-01 单批次兼容)"""
+        lots = d.get('lots') or [{"date": "2020-01-01", "shares": d.get('shares', 0.0), "cost_per_share": d.get('cost', 0.0)}]
+        return cls(
+            code=str(d['code']), name=d.get('name', ''),
+            lots=LotBook.from_records(lots),
+            atr_at_entry=float(d.get('atr_at_entry', 0.0)),
+            stop_loss_price=float(d.get('stop_loss', 0.0) or 0.0),
+            target_price=float(d.get('target', 0.0) or 0.0),
+            highest_nav=float(d.get('highest_nav', 0.0) or 0.0),
+            wave_pattern=d.get('wave_pattern', "Unknown"),
+            partial_profit_taken=bool(d.get('partial_sold', False)),
+            entry_date=d.get('date', ''),
+            extra={k: v for k, v in d.items() if k not in _HOLDING_KEYS},
+        )
+
+    def to_dict(self) -> Dict:
+        """序列化为云端 JSON 持仓记录 (与 bot_cron 读取的字段保持一致)"""
+        d = {
+            "code": self.code, "name": self.name,
+            "shares": self.total_shares, "cost": self.avg_cost,
+            "date": self.entry_date or (self.lots.dates[0] if len(self.lots) else ""),
+            "stop_loss": self.stop_loss_price, "target": self.target_price,
+            "partial_sold": self.partial_profit_taken,
+            "lots": self.lots.to_records(),
+        }
+        if self.highest_nav > 0: d["highest_nav"] = self.highest_nav
+        if self.atr_at_entry: d["atr_at_entry"] = self.atr_at_entry
+        if self.wave_pattern != "Unknown": d["wave_pattern"] = self.wave_pattern
+        d.update(self.extra)
+        return d
+
 # === 基础服务类 ===
 
 class IndicatorEngine:
     @staticmethod
-    def calculate_indicators(df: pd.DataFrame) -> pd.DataFrame:
+    def calculate_indicators(df: pd.DataFrame, compact=False, columns=None) -> pd.DataFrame:
+        """
+        columns 指定时只计算这些列 (及其依赖)；
+        compact=True 时默认只保留 COMPACT_COLUMNS，并转为 float32 (按 float64 计算后再转换)。
+        """
         if df.empty: return df
-        data = df.copy()
-        
-        # 基础均线
-        data['ema_21'] = data['nav'].ewm(span=21, adjust=False).mean() 
-        data['ema_55'] = data['nav'].ewm(span=55, adjust=False).mean() 
-        data['ema_89'] = data['nav'].ewm(span=89, adjust=False).mean() 
-        data['ema_144'] = data['nav'].ewm(span=144, adjust=False).mean()
-        
-        # 唐奇安通道
-        data['high_20'] = data['nav'].rolling(window=20).max()
-        data['low_20'] = data['nav'].rolling(window=20).min()
-        
-        # MACD
-        exp12 = data['nav'].ewm(span=12, adjust=False).mean()
-        exp26 = data['nav'].ewm(span=26, adjust=False).mean()
-        data['macd'] = exp12 - exp26
-        data['signal'] = data['macd'].ewm(span=9, adjust=False).mean()
-        data['hist'] = data['macd'] - data['signal']
-        
-        # RSI
-        delta = data['nav'].diff()
-        gain = (delta.where(delta > 0, 0)).rolling(window=14).mean()
-        loss = (-delta.where(delta < 0, 0)).rolling(window=14).mean()
-        rs = gain / loss
-        data['rsi'] = 100 - (100 / (1 + rs))
-        data['rsi_prev'] = data['rsi'].shift(1)
-        
-        # ATR
-        data['tr'] = data['nav'].diff().abs()
-        data['atr'] = data['tr'].rolling(window=14).mean()
-        
-        # AO Indicator
-        data['ao'] = data['nav'].rolling(window=5).mean() - data['nav'].rolling(window=34).mean()
-        data['ao_prev'] = data['ao'].shift(1)
-        
-        # Return for Correlation
-        data['pct_change'] = data['nav'].pct_change()
-        
+        wanted = columns or (COMPACT_COLUMNS if compact else INDICATOR_COLUMNS)
+        data = compute_indicators(df, wanted)
+        if compact: return data[['nav'] + [c for c in wanted if c != 'nav']].astype(np.float32)
         return data
 
+class BackgroundRefresh:
+    """
+    进程级的"过期前后台刷新"结果：读取直接返回已有结果，年龄超过 ttl * ahead 时由一个后台线程重算
+    (同一时刻至多一个，失败则保留旧结果)。从未算过或结果超过 max_age (默认 2 * ttl) 时同步计算。
+    失败会打印并按指数退避 (RETRY_MIN ~ RETRY_MAX 秒) 暂停重试，而不是每次读取都再发起一次。
+    """
+    RETRY_MIN = 60
+    RETRY_MAX = 1800
+
+    def __init__(self, fn, ttl, ahead=0.8, max_age=None):
+        self.fn, self.ttl, self.ahead = fn, ttl, ahead
+        self.max_age = max_age or ttl * 2
+        self.lock = threading.Lock()
+        self.first = threading.Lock()  # 同步计算只让一个调用者做，其余等它的结果
+        self.value, self.stamp, self.running = None, 0.0, False
+        self.error, self.retry_at, self.backoff = None, 0.0, 0.0
+
+    def _usable(self, now):
+        return self.stamp and now - self.stamp < self.max_age
+
+    def get(self):
+        now = time.monotonic()
+        with self.lock:
+            if self._usable(now):
+                if now - self.stamp >= self.ttl * self.ahead and not self.running and now >= self.retry_at:
+                    self.running = True
+                    threading.Thread(target=self._background, daemon=True).start()
+                return self.value
+        with self.first:
+            now = time.monotonic()
+            if self._usable(now): return self.value
+            if self.error is not None and now < self.retry_at: raise self.error
+            return self.refresh()
+
+    def refresh(self):
+        """立即重算并替换结果 (预热任务直接调用)；失败时记录、退避并抛出"""
+        try:
+            value = self.fn()
+        except Exception as e:
+            with self.lock:
+                self.error = e
+                self.backoff = min(max(self.backoff * 2, self.RETRY_MIN), self.RETRY_MAX)
+                self.retry_at = time.monotonic() + self.backoff
+            print(f"后台刷新 {getattr(self.fn, '__name__', self.fn)} 失败 ({self.backoff:.0f} 秒后重试): {e}")
+            raise
+        with self.lock:
+            self.value, self.stamp = value, time.monotonic()
+            self.error, self.retry_at, self.backoff = None, 0.0, 0.0
+        return value
+
+    def _background(self):
+        try: self.refresh()
+        except Exception: pass  # refresh 已记录并设置退避
+        finally:
+            with self.lock: self.running = False
+
 class DataService:
     @staticmethod
     @st.cache_data(ttl=3600)
     def fetch_nav_history(code):
+        # 本地净值面板足够新时直接映射读取，免去网络请求
+        cached = nav_panel.lookup(code, nav_panel.required_nav_date(get_bj_time()))
+        if cached is not None: return cached
+        return DataService.download_nav_history(code)
+
+    @staticmethod
+    def download_nav_history(code):
+        """从接口下载净值历史 (不查面板、不缓存)；失败返回空表"""
         try:
-            df = ak.fund_open_fund_info_em(symbol=code, indicator="单位净值走势")
+            df = em_transport.ak_call(ak.fund_open_fund_info_em, symbol=code, indicator="单位净值走势")
             if df.empty: return pd.DataFrame()
             df = df.rename(columns={"净值日期": "date", "单位净值": "nav"})
             df['date'] = pd.to_datetime(df['date'])
@@ -315,39 +485,102 @@ class DataService:
         except Exception as e: 
             return pd.DataFrame()
         
+    @staticmethod
+    @st.cache_resource
+    def _pivot_store():
+        return {'lock': threading.Lock(), 'index': OrderedDict()}
+
+    @staticmethod
+    def get_pivot_index(code, df) -> 'PivotIndex':
+        """按基金缓存的多尺度拐点索引，随净值缓存增量同步 (跨会话共享，最近使用的 PIVOT_CACHE_MAX 只)"""
+        store = DataService._pivot_store()
+        with store['lock']:
+            index = store['index']
+            p_index = index.pop(code, None)
+            p_index = PivotIndex(df['nav']) if p_index is None else p_index.sync(df['nav'])
+            index[code] = p_index
+            while len(index) > PIVOT_CACHE_MAX: index.popitem(last=False)
+        return p_index
+
+    @staticmethod
+    def chart_pivots(code, df, df_calc, scale, used_est):
+        """
+        图表切换波段尺度用：查全历史拐点索引，截取图表窗口 (只用于展示，信号判定不走这里)。
+        全历史状态机在窗口起点附近确认的拐点可能与诊断所用的近 150 根切片不同，滑块说明 (SCALE_HELP) 已注明。
+        """
+        est_bar = (df_calc.index[-1], df_calc['nav'].iloc[-1]) if used_est else None
+        return DataService.get_pivot_index(code, df).pivots(scale, since=df_calc.index[-150:][0], est=est_bar)
+
+    @staticmethod
+    def fetch_nav_histories(codes, lane="scan"):
+        """并发取多只基金的净值历史 {code: df}，各自走 fetch_nav_history 的缓存 / 面板"""
+        client = em_transport.current_client()
+        def load(code):
+            with em_transport.lane(lane, client):
+                return code, DataService.fetch_nav_history(code)
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            return dict(executor.map(load, codes))
+
+    @staticmethod
+    @st.cache_resource
+    def _return_store():
+        # scope -> (ReturnPanel, 净值日)；持仓与候选池各自一个面板，互不拖累
+        return {'lock': threading.Lock(), 'panels': {}}
+
+    @staticmethod
+    def get_correlation(codes, scope="holdings") -> pd.DataFrame:
+        """
+        codes 两两之间近 CORR_WINDOW 个净值日的收益相关系数 (按 scope 跨会话共享收益面板)。
+        同一净值日内重复调用直接查表；净值日前进时增量更新；请求了面板外的基金时按本次 codes 重建，
+        不再请求的基金随之移出。下载在锁外进行，不阻塞其他会话。
+        """
+        store = DataService._return_store()
+        required = nav_panel.required_nav_date(get_bj_time())
+        wanted = list(dict.fromkeys(codes))
+        with store['lock']:
+            entry = store['panels'].get(scope)
+            panel, nav_date = entry or (None, None)
+            rebuild = panel is None or any(c not in panel.pos for c in wanted)
+            if not rebuild and nav_date == required: return panel.corr(wanted)
+            fetch_codes = wanted if rebuild else panel.codes
+
+        frames = DataService.fetch_nav_histories(fetch_codes)
+
+        with store['lock']:
+            if store['panels'].get(scope) is entry:
+                panel = ReturnPanel(fetch_codes, frames) if rebuild else panel.sync(frames)
+                store['panels'][scope] = (panel, required)
+                return panel.corr(wanted)
+            # 等待下载期间面板已被其他会话更新：够用就用，否则用本次数据单独计算 (不入共享面板)
+            panel, nav_date = store['panels'][scope]
+            if nav_date == required and all(c in panel.pos for c in wanted): return panel.corr(wanted)
+        return ReturnPanel(fetch_codes, frames).corr(wanted)
+
     @staticmethod
     @st.cache_data(ttl=3600*24)
     def get_market_index_trend():
         try:
             df = DataService.fetch_nav_history("000300")
             if df.empty: return 0 
-            df = IndicatorEngine.calculate_indicators(df)
             last_price = df['nav'].iloc[-1]
-            ema144 = df['ema_144'].iloc[-1]
+            ema144 = LazyIndicators(df)['ema_144'].iloc[-1]
             if last_price > ema144: return 1
             else: return -1
         except: return 0 
 
     @staticmethod
-    def get_realtime_estimate(code):
-        try:
-            ts = int(time.time() * 1000)
-            url = f"http://fundgz.1234567.com.cn/js/{code}.js?rt={ts}"
-            r = requests.get(url, timeout=1)
-            if r.status_code == 200:
-                txt = r.text
-                match = re.findall(r'\((.*?)\)', txt)
-                if match:
-                    json_str = match[0]
-                    data = json.loads(json_str)
-                    return float(data['gsz']), float(data['gszzl']), data['gztime']
-            return None, None, None
+    def get_realtime_estimate(code, hedge=False):
+        """hedge=True 用于持仓：估值接口迟迟不回时补发一次对冲请求"""
+        data = em_transport.fetch_estimate(code, timeout=1, hedge=hedge)
+        if not data: return None, None, None
+        try: return float(data['gsz']), float(data['gszzl']), data['gztime']
         except: return None, None, None
     
     @staticmethod
-    def get_smart_price(code, cost_basis=0.0):
-        df = DataService.fetch_nav_history(code)
-        est_p, _, _ = DataService.get_realtime_estimate(code)
+    def get_smart_price(code, cost_basis=0.0, hedge=False):
+        with em_transport.lane("holdings" if hedge else None):
+            df = DataService.fetch_nav_history(code)
+        est_p, _, _ = DataService.get_realtime_estimate(code, hedge=hedge)
 
         curr_price = cost_basis
         today_str = get_bj_time().date().strftime("%Y-%m-%d")
@@ -371,8 +604,17 @@ class DataService:
         return curr_price, df, used_est, info_tag
     
     @staticmethod
-    @st.cache_data(ttl=3600*12)
+    @st.cache_resource
+    def _regime_refresh():
+        return BackgroundRefresh(DataService._compute_market_regime, ttl=3600*12)
+
+    @staticmethod
     def get_market_regime():
+        """全市场温度计 (后台定时刷新，读取不等待)"""
+        return DataService._regime_refresh().get()
+
+    @staticmethod
+    def _compute_market_regime():
         """
         全市场温度计：多维度扫描核心指数
         """
@@ -386,14 +628,14 @@ class DataService:
         
         bullish_count = 0
         details = []
+        histories = DataService.fetch_nav_histories([idx['code'] for idx in indices])
         
         for idx in indices:
-            df = DataService.fetch_nav_history(idx['code'])
+            df = histories[idx['code']]
             status = "⚪"
             if not df.empty and len(df) > 100:
-                df = IndicatorEngine.calculate_indicators(df)
                 last_p = df['nav'].iloc[-1]
-                ema89 = df['ema_89'].iloc[-1]
+                ema89 = LazyIndicators(df)['ema_89'].iloc[-1]
                 if last_p > ema89:
                     bullish_count += 1
                     status = "🔴" 
@@ -411,14 +653,74 @@ class DataService:
         return {"score": score, "regime": regime, "details": details}
 
     @staticmethod
-    @st.cache_data(ttl=3600*12)
+    @st.cache_data(ttl=3600)
+    def get_feature_rows():
+        """
+        夜间特征库 (bot_cron --build-features 产出)：{code: {列: 值, 'pivots': [...]}}。
+        未构建或净值日期早于上一个交易日 (构建失败) 时返回 {}，末根早于上一个交易日的基金不返回；调用方回退到现场计算。
+        """
+        try:
+            conn = st.connection("supabase", type=SupabaseConnection)
+            res = conn.table("trader_storage").select("portfolio_data").eq("id", "feature_store").execute()
+            table = res.data[0]['portfolio_data'] if res.data else {}
+        except Exception:
+            return {}
+        # 按交易日历判断 (节后首日不误判过期)；当晚净值发布到夜间构建之间仍认前一交易日的库
+        day = nav_panel.previous_trading_day(get_bj_time().date())
+        if not table or (table.get('nav_date') or '') < str(day): return {}
+        cols, pivots = table['columns'], table.get('pivots', [])
+        # 表级 nav_date 只是各行的最大值：构建时官方净值未发布的基金按行剔除，由调用方现场计算
+        rows = {}
+        for i, code in enumerate(table['codes']):
+            if cols['date'][i] < str(day): continue
+            rows[code] = {k: v[i] for k, v in cols.items()}
+            if i < len(pivots): rows[code]['pivots'] = pivots[i]
+        return rows
+
+    @staticmethod
+    def get_momentum(code, window=120):
+        """window 日涨幅：优先取夜间特征库，库里没有的现场下载计算；历史不足返回 None"""
+        row = DataService.get_feature_rows().get(code)
+        if row and f'mom_{window}' in row: return row[f'mom_{window}']
+        df = DataService.fetch_nav_history(code)
+        if len(df) <= window: return None
+        p_now = df['nav'].iloc[-1]; p_old = df['nav'].iloc[-window]
+        return (p_now - p_old) / p_old
+
+    @staticmethod
+    @st.cache_data(ttl=3600)
+    def get_momentum_distribution(codes, window=120):
+        """
+        codes (元组) 的 window 日涨幅分布：夜间特征库优先，库里没有的并发下载现场计算。
+        按小时缓存，体检时对任意基金只做 O(log n) 的分位查询。
+        """
+        rows = DataService.get_feature_rows()
+        moms = {c: rows[c][f'mom_{window}'] for c in codes if f'mom_{window}' in rows.get(c, {})}
+        for c, df in DataService.fetch_nav_histories([c for c in codes if c not in moms]).items():
+            if len(df) > window:
+                p_now = df['nav'].iloc[-1]; p_old = df['nav'].iloc[-window]
+                moms[c] = (p_now - p_old) / p_old
+        return MomentumDistribution(list(moms.values()))
+
+    @staticmethod
+    @st.cache_resource
+    def _sector_refresh():
+        return BackgroundRefresh(DataService._compute_sector_rankings, ttl=3600*12)
+
+    @staticmethod
     def get_sector_rankings():
+        """行业轮动雷达 (后台定时刷新，读取不等待)"""
+        return DataService._sector_refresh().get()
+
+    @staticmethod
+    def _compute_sector_rankings():
         """
         行业轮动雷达：计算各大赛道代表ETF的动能
         """
         rankings = []
+        histories = DataService.fetch_nav_histories([s['code'] for s in SECTOR_ETF_POOL])
         for s in SECTOR_ETF_POOL:
-            df = DataService.fetch_nav_history(s['code'])
+            df = histories[s['code']]
             mom = -999
             if len(df) > 20:
                 p_now = df['nav'].iloc[-1]
@@ -431,65 +733,254 @@ class DataService:
         
     @staticmethod
     @st.cache_data(ttl=3600*24)
+    def get_trading_calendar():
+        """交易所交易日历 (YYYY-MM-DD 列表)；失败返回空列表，调用方按工作日近似"""
+        try:
+            df = em_transport.ak_call(ak.tool_trade_date_hist_sina)
+            return [str(d)[:10] for d in df['trade_date']]
+        except Exception:
+            return []
+
+    @staticmethod
+    @st.cache_resource
+    def _pool_refresh():
+        return BackgroundRefresh(DataService._compute_market_wide_pool, ttl=3600*24)
+
+    @staticmethod
     def get_market_wide_pool():
+        """全市场候选池 (后台定时刷新)；排行接口失败且没有可用结果时返回兜底池，兜底结果不缓存"""
         try:
-            df = ak.fund_open_fund_rank_em(symbol="全部")
-            mask_type = df['基金简称'].str.contains('债|货币|理财|美元|定开|持有|养老|以太|比特币|港股|QDII', regex=True) == False
-            df = df[mask_type]
-            df = df.dropna(subset=['近1年'])
-            df_top = df.sort_values(by="近6月", ascending=False).head(600)
+            return [dict(f) for f in DataService._pool_refresh().get()]
+        except Exception:
+            return [{"code": "012414", "name": "招商中证白酒指数C"}]
+
+    @staticmethod
+    def _compute_market_wide_pool():
+        df = em_transport.ak_call(ak.fund_open_fund_rank_em, symbol="全部")
+        mask_type = df['基金简称'].str.contains('债|货币|理财|美元|定开|持有|养老|以太|比特币|港股|QDII', regex=True) == False
+        df = df[mask_type]
+        df = df.dropna(subset=['近1年'])
+        df_top = df.sort_values(by="近6月", ascending=False).head(600)
+        
+        best_candidates = {}
+        for _, row in df_top.iterrows():
+            raw_name = row['基金简称']
+            code = str(row['基金代码'])
+            clean_name = re.sub(r'[A-Z]$', '', raw_name) 
+            clean_name = re.sub(r'发起式$', '', clean_name)
+            clean_name = re.sub(r'联接$', '', clean_name)
+            clean_name = re.sub(r'ETF$', '', clean_name)
             
-            best_candidates = {}
-            for _, row in df_top.iterrows():
-                raw_name = row['基金简称']
-                code = str(row['基金代码'])
-                clean_name = re.sub(r'[A-Z]$', '', raw_name) 
-                clean_name = re.sub(r'发起式$', '', clean_name)
-                clean_name = re.sub(r'联接$', '', clean_name)
-                clean_name = re.sub(r'ETF$', '', clean_name)
-                
-                is_current_c = raw_name.endswith('C')
-                
-                if clean_name not in best_candidates:
-                    best_candidates[clean_name] = {"code": code, "name": raw_name, "is_c": is_current_c}
-                else:
-                    existing_is_c = best_candidates[clean_name]['is_c']
-                    if is_current_c and not existing_is_c:
-                        best_candidates[clean_name] = {"code": code, "name": raw_name, "is_c": True}
+            is_current_c = raw_name.endswith('C')
             
-            pool = []
-            for item in best_candidates.values():
-                pool.append({"code": item['code'], "name": item['name']})
-                if len(pool) >= 200: 
-                    break
-            return pool
-        except Exception as e: 
-            return [{"code": "012414", "name": "招商中证白酒指数C"}]
+            if clean_name not in best_candidates:
+                best_candidates[clean_name] = {"code": code, "name": raw_name, "is_c": is_current_c}
+            else:
+                existing_is_c = best_candidates[clean_name]['is_c']
+                if is_current_c and not existing_is_c:
+                    best_candidates[clean_name] = {"code": code, "name": raw_name, "is_c": True}
+        
+        pool = []
+        for item in best_candidates.values():
+            pool.append({"code": item['code'], "name": item['name']})
+            if len(pool) >= 200: 
+                break
+        if not pool: raise ValueError("基金排行为空")
+        return pool
+
+class CacheWarmer:
+    """
+    进程级缓存预热线程：启动时先跑一次，之后按北京时间交易日历在 WARM_SCHEDULE 各时刻运行，
+    刷新全市场池、净值历史 (写回本地面板)、市场温度与行业排名，早盘第一个用户不再等待下载。
+    """
+
+    def __init__(self, schedule=WARM_SCHEDULE):
+        self.schedule = sorted(schedule)
+        self.last_run = None
+        self.last_error = None
+        threading.Thread(target=self._loop, daemon=True, name="cache-warmer").start()
+
+    def next_run(self, now):
+        """now (北京时间，不带时区) 之后最近的预热时刻"""
+        day = now.date()
+        while True:
+            if nav_panel.is_trading_day(day):
+                for h, m in self.schedule:
+                    at = datetime.datetime.combine(day, datetime.time(h, m))
+                    if at > now: return at
+            day += datetime.timedelta(days=1)
+
+    def _loop(self):
+        while True:
+            try:
+                nav_panel.set_trading_calendar(DataService.get_trading_calendar())
+                self.run_once()
+            except Exception as e:
+                self.last_error = f"{get_bj_time():%m-%d %H:%M} {e}"
+            now = get_bj_time().replace(tzinfo=None)
+            time.sleep(max((self.next_run(now) - now).total_seconds(), 60))
+
+    def run_once(self):
+        """
+        各项原地刷新，刷新完成前旧结果照常可读 (不清缓存)。预热走回测车道，让位于用户请求；
+        单项失败不影响其余项 (BackgroundRefresh 已记录并退避)。
+        """
+        with em_transport.lane("backtest"):
+            try: DataService._pool_refresh().refresh()
+            except Exception: pass
+            pool = DataService.get_market_wide_pool()
+            codes = [f['code'] for f in pool + STATIC_OTF_POOL + SECTOR_ETF_POOL] + CacheWarmer._portfolio_codes()
+            # 面板里还不够新的才下载并写回面板；fetch_nav_history 的缓存条目过期后即读到新面板
+            required = nav_panel.required_nav_date(get_bj_time())
+            stale = [c for c in dict.fromkeys(codes) if not nav_panel.is_fresh(c, required)]
+            def load(code):
+                with em_transport.lane("backtest"):
+                    return code, DataService.download_nav_history(code)
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                frames = {c: df[['nav']] for c, df in executor.map(load, stale) if not df.empty}
+            if frames:
+                try: nav_panel.merge(frames)
+                except OSError as e: print(f"写入净值面板失败: {e}")
+            for refresh in (DataService._regime_refresh(), DataService._sector_refresh()):
+                try: refresh.refresh()
+                except Exception: pass
+        self.last_run = get_bj_time()
+
+    @staticmethod
+    def _portfolio_codes():
+        """默认账户的持仓与在途订单代码 (读取失败时为空)"""
+        try:
+            conn = st.connection("supabase", type=SupabaseConnection)
+            res = conn.table("trader_storage").select("portfolio_data").eq("id", "default_user").execute()
+            data = res.data[0]['portfolio_data'] if res.data else {}
+        except Exception:
+            return []
+        return [x['code'] for x in (data.get('holdings') or []) + (data.get('pending_orders') or [])]
+
+@st.cache_resource
+def start_cache_warmer():
+    """每个进程只启动一个预热线程"""
+    return CacheWarmer()
 
 # === 核心逻辑类 ===
 
+class PivotIndex:
+    """
+    单只基金的多尺度拐点索引：每个偏离阈值一条 ZigZagTracker，覆盖全部官方净值。
+    新净值到达时增量追加，任意支持尺度的查询都是查表；盘中估值通过 preview 叠加，不改动索引。
+    """
+    DEVIATIONS = (0.03, 0.05, 0.08, 0.13)
+    __slots__ = ('n', 'last_date', 'trackers')
+
+    def __init__(self, series: pd.Series):
+        self.n = len(series); self.last_date = series.index[-1]
+        self.trackers = {d: ZigZagTracker.from_series(series, d) for d in self.DEVIATIONS}
+
+    def sync(self, series: pd.Series) -> 'PivotIndex':
+        """与最新官方净值对齐：前缀一致时只追加新K线，否则重建"""
+        if len(series) < self.n or series.index[self.n - 1] != self.last_date:
+            return PivotIndex(series)
+        new = series.iloc[self.n:]
+        if len(new):
+            for tracker in self.trackers.values(): tracker.extend(new.to_numpy(dtype=float), new.index)
+            self.n = len(series); self.last_date = series.index[-1]
+        return self
+
+    def pivots(self, deviation_pct=0.05, since=None, est=None) -> List[Dict]:
+        """
+        deviation_pct 尺度的拐点。since: 只保留该日期之后的拐点 (外加之前最近一个作为起点)；
+        est: (日期, 估值) 盘中估值K线。
+        """
+        if self.n < 10: return []
+        tracker = self.trackers[deviation_pct]
+        pts = tracker.preview(est[1], est[0]) if est else tracker.pivots()
+        if since is not None:
+            first = next((i for i, p in enumerate(pts) if p['date'] >= since), len(pts))
+            pts = pts[max(first - 1, 0):]
+        return pts
+
+class ReturnPanel:
+    """
+    多只基金对齐到同一日期轴的日收益 (最近 window 个净值日)，附带相关性的充分统计量：
+    两两共同样本数 n、求和 sx、平方和 sxx、交叉积 sxy (成对剔除 NaN，与 DataFrame.corr 一致)。
+    新净值日只对变动的行做加减 (每行 O(N²))，相关矩阵直接由统计量得出，无需重新 concat / corr。
+    """
+
+    def __init__(self, codes, frames, window=CORR_WINDOW):
+        self.codes = list(codes)
+        self.pos = {c: i for i, c in enumerate(self.codes)}
+        self.window = window
+        k = len(self.codes)
+        self.n, self.sx, self.sxx, self.sxy = (np.zeros((k, k)) for _ in range(4))
+        self.updates = 0
+        self.returns = self._returns(frames)
+        self._apply(self.returns.to_numpy(), 1)
+
+    def _returns(self, frames) -> pd.DataFrame:
+        cols = {}
+        for c in self.codes:
+            df = frames.get(c)
+            if df is not None and not df.empty:
+                cols[c] = df['nav'].iloc[-(self.window + 1):].pct_change().iloc[1:]
+        return pd.DataFrame(cols, dtype=float).reindex(columns=self.codes).iloc[-self.window:]
+
+    def _apply(self, rows, sign):
+        mask = ~np.isnan(rows)
+        x = np.where(mask, rows, 0.0)
+        m = mask.astype(float)
+        self.n += sign * (m.T @ m)
+        self.sx += sign * (x.T @ m)
+        self.sxx += sign * ((x * x).T @ m)
+        self.sxy += sign * (x.T @ x)
+
+    def sync(self, frames) -> 'ReturnPanel':
+        """按最新净值更新：移出 / 改动的旧行减去，新增 / 改动的行加上；累计更新满一个窗口后重建以清除舍入误差"""
+        if self.updates >= self.window: return ReturnPanel(self.codes, frames, self.window)
+        old, new = self.returns, self._returns(frames)
+        common = old.index.intersection(new.index)
+        a, b = old.loc[common].to_numpy(), new.loc[common].to_numpy()
+        keep = common[((a == b) | (np.isnan(a) & np.isnan(b))).all(axis=1)]
+        self._apply(old.drop(keep).to_numpy(), -1)
+        self._apply(new.drop(keep).to_numpy(), 1)
+        self.returns = new
+        self.updates += 1
+        return self
+
+    def corr(self, codes=None, min_periods=CORR_MIN_OBS) -> pd.DataFrame:
+        codes = self.codes if codes is None else list(codes)
+        ix = np.ix_([self.pos[c] for c in codes], [self.pos[c] for c in codes])
+        n, sx, sxx, sxy = self.n[ix], self.sx[ix], self.sxx[ix], self.sxy[ix]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cov = n * sxy - sx * sx.T
+            var = (n * sxx - sx ** 2) * (n * sxx.T - sx.T ** 2)
+            out = np.clip(cov / np.sqrt(var), -1, 1)
+        out[(n < max(min_periods, 2)) | ~(var > 0)] = np.nan
+        return pd.DataFrame(out, index=codes, columns=codes)
+
+class MomentumDistribution:
+    """一组基金动能的升序向量 (剔除缺失值)，分位与阈值查询都是二分查找"""
+
+    def __init__(self, values):
+        v = np.asarray(values, dtype=float)
+        self.values = np.sort(v[~np.isnan(v)])
+
+    def __len__(self):
+        return len(self.values)
+
+    def percentile(self, mom) -> float:
+        """不高于 mom 的比例 (0~1，越大越强)"""
+        if not len(self.values): return float('nan')
+        return np.searchsorted(self.values, mom, side='right') / len(self.values)
+
+    def cutoff(self, top=0.3) -> float:
+        """前 top 比例的门槛 (与降序排序后取第 int(n * top) 名一致)"""
+        return self.values[len(self.values) - 1 - int(len(self.values) * top)]
+
 class WaveEngine:
     @staticmethod
     def zig_zag(series: pd.Series, deviation_pct=0.05) -> List[Dict]: 
-        pivots = [] 
         if len(series) < 10: return []
-        direction = 0; last_pivot_idx = 0; last_pivot_val = series.iloc[0]
-        dates = series.index
-        pivots.append({'idx': 0, 'date': dates[0], 'val': last_pivot_val, 'type': 'start'})
-        for i in range(1, len(series)):
-            curr_val = series.iloc[i]
-            change = (curr_val - last_pivot_val) / last_pivot_val
-            if direction == 0:
-                if change >= deviation_pct: direction = 1; last_pivot_idx = i; last_pivot_val = curr_val
-                elif change <= -deviation_pct: direction = -1; last_pivot_idx = i; last_pivot_val = curr_val
-            elif direction == 1:
-                if curr_val > last_pivot_val: last_pivot_idx = i; last_pivot_val = curr_val
-                elif change <= -deviation_pct: pivots.append({'idx': last_pivot_idx, 'date': dates[last_pivot_idx], 'val': last_pivot_val, 'type': 'high'}); direction = -1; last_pivot_idx = i; last_pivot_val = curr_val
-            elif direction == -1:
-                if curr_val < last_pivot_val: last_pivot_idx = i; last_pivot_val = curr_val
-                elif change >= deviation_pct: pivots.append({'idx': last_pivot_idx, 'date': dates[last_pivot_idx], 'val': last_pivot_val, 'type': 'low'}); direction = 1; last_pivot_idx = i; last_pivot_val = curr_val
-        pivots.append({'idx': last_pivot_idx, 'date': dates[last_pivot_idx], 'val': last_pivot_val, 'type': 'high' if direction==1 else 'low'})
-        return pivots
+        return ZigZagTracker.from_series(series, deviation_pct).pivots()
 
     @staticmethod
     def analyze_structure(df_slice: pd.DataFrame, pivots: List[Dict]) -> Dict:
@@ -546,10 +1037,11 @@ class WaveEngine:
 
         # === 策略 C: 逃顶 ===
         if len(df_slice) > 60:
-            price_window = df_slice['nav'].iloc[-60:]
-            if last_nav >= price_window.max() * 0.99:
-                ao_window = df_slice['ao'].iloc[-60:]
-                if ao_curr < ao_window.max() * 0.7: 
+            # 优先读预计算的滚动高点列 (回测逐日调用时不再重复扫描窗口)
+            price_high = df_slice['high_60'].iloc[-1] if 'high_60' in df_slice else df_slice['nav'].iloc[-60:].max()
+            if last_nav >= price_high * 0.99:
+                ao_high = df_slice['ao_high_60'].iloc[-1] if 'ao_high_60' in df_slice else df_slice['ao'].iloc[-60:].max()
+                if ao_curr < ao_high * 0.7: 
                     result.update({
                         'status': 'Sell', 
                         'score': -95, 
@@ -658,10 +1150,11 @@ class RealBacktester:
 
 
 class PortfolioBacktester:
-    def __init__(self, pool_codes, start_date, end_date):
+    def __init__(self, pool_codes, start_date, end_date, compact=COMPACT_INDICATORS):
         self.pool = pool_codes
         self.start_date = pd.to_datetime(start_date)
         self.end_date = pd.to_datetime(end_date)
+        self.compact = compact
         self.data_map = {} 
         
     def preload_data(self):
@@ -682,11 +1175,13 @@ class PortfolioBacktester:
         total = len(codes_to_load)
         
         # 2. 定义单个下载任务函数
+        client = em_transport.current_client()
         def load_single_fund(fund_info):
-            # 获取数据并计算指标
-            df = DataService.fetch_nav_history(fund_info['code'])
+            # 获取数据并计算指标 (回测车道，让位于持仓与扫描请求)
+            with em_transport.lane("backtest", client):
+                df = DataService.fetch_nav_history(fund_info['code'])
             if not df.empty:
-                return fund_info['code'], IndicatorEngine.calculate_indicators(df)
+                return fund_info['code'], IndicatorEngine.calculate_indicators(df, compact=self.compact)
             return fund_info['code'], None
 
         # 3. 并行执行
@@ -704,6 +1199,13 @@ class PortfolioBacktester:
                 completed_count += 1
                 progress_bar.progress(completed_count / total)
         
+        # 4. 新下载的历史写回本地净值面板，下次冷启动直接映射读取
+        required = nav_panel.required_nav_date(get_bj_time())
+        stale = {c: d[['nav']] for c, d in self.data_map.items() if not nav_panel.is_fresh(c, required)}
+        if stale:
+            try: nav_panel.merge(stale)
+            except OSError: pass
+        
         progress_text.empty()
         progress_bar.empty()
 
@@ -729,6 +1231,16 @@ class PortfolioBacktester:
             
         sorted_dates = sorted(list(all_dates))
         
+        # 各基金在统一日期轴上的行号 (向前取最近一行，-1 表示尚无数据)；逐日循环里只做整数下标，不再查 DatetimeIndex
+        axis = pd.DatetimeIndex(sorted_dates).values
+        rows, present, navs = {}, {}, {}
+        for code, df in list(self.data_map.items()) + [(None, benchmark_df)]:
+            if df.empty: continue
+            r = np.searchsorted(df.index.values, axis, side='right') - 1
+            rows[code] = r
+            present[code] = (r >= 0) & (df.index.values[np.maximum(r, 0)] == axis)
+            navs[code] = df['nav'].to_numpy()
+        
         capital = initial_capital
         total_principal = initial_capital 
         
@@ -774,12 +1286,9 @@ class PortfolioBacktester:
                         
                         # Benchmark 定投
                         if not benchmark_df.empty:
-                            b_price = benchmark_df.loc[curr_date]['nav'] if curr_date in benchmark_df.index else 0
-                            if b_price == 0: # 回溯找最近价格
-                                try:
-                                    b_idx = benchmark_df.index.get_indexer([curr_date], method='pad')[0]
-                                    if b_idx != -1: b_price = benchmark_df.iloc[b_idx]['nav']
-                                except: pass
+                            # 当日无净值时回溯最近价格
+                            b_idx = rows[None][i]
+                            b_price = navs[None][b_idx] if b_idx != -1 else 0
                             
                             if b_price > 0:
                                 bench_shares += monthly_deposit / b_price
@@ -804,12 +1313,8 @@ class PortfolioBacktester:
             # 计算持仓市值
             current_hold_val = 0
             for h_code, h in holdings.items():
-                df = self.data_map.get(h_code)
-                if df is not None and curr_date in df.index:
-                    current_hold_val += h['shares'] * df.loc[curr_date]['nav']
-                elif df is not None:
-                        idx = df.index.get_indexer([curr_date], method='pad')[0]
-                        if idx != -1: current_hold_val += h['shares'] * df.iloc[idx]['nav']
+                idx = rows[h_code][i] if h_code in rows else -1
+                if idx != -1: current_hold_val += h['shares'] * navs[h_code][idx]
             
             current_equity = capital + current_hold_val + pending_val
             daily_buy_count = 0 
@@ -817,12 +1322,8 @@ class PortfolioBacktester:
             # 计算 Benchmark 市值
             bench_val = bench_cash
             if not benchmark_df.empty:
-                b_now = benchmark_df.loc[curr_date]['nav'] if curr_date in benchmark_df.index else 0
-                if b_now == 0:
-                    try:
-                        b_idx = benchmark_df.index.get_indexer([curr_date], method='pad')[0]
-                        if b_idx != -1: b_now = benchmark_df.iloc[b_idx]['nav']
-                    except: pass
+                b_idx = rows[None][i]
+                b_now = navs[None][b_idx] if b_idx != -1 else 0
                 if b_now > 0:
                     bench_val += bench_shares * b_now
             
@@ -833,14 +1334,12 @@ class PortfolioBacktester:
                 last_rebalance_idx = i
                 
                 mom_scores_all = []
-                for code, df in self.data_map.items():
-                    if curr_date not in df.index: continue
-                    idx = df.index.get_indexer([curr_date], method='nearest')[0]
+                for code in self.data_map:
+                    if not present[code][i]: continue
+                    idx = rows[code][i]
                     if idx < MOMENTUM_WINDOW: continue
-                    past_slice = df.iloc[idx-MOMENTUM_WINDOW : idx+1]
-                    if past_slice.empty: continue
-                    start_p = past_slice['nav'].iloc[0]
-                    end_p = past_slice['nav'].iloc[-1]
+                    start_p = navs[code][idx - MOMENTUM_WINDOW]
+                    end_p = navs[code][idx]
                     mom = (end_p - start_p) / start_p
                     mom_scores_all.append({'code': code, 'mom': mom})
                 
@@ -855,8 +1354,8 @@ class PortfolioBacktester:
                         if curr_mom < cutoff_val:
                             info = holdings[h_code]
                             h_curr_nav = info['cost']
-                            if curr_date in self.data_map[h_code].index:
-                                h_curr_nav = self.data_map[h_code].loc[curr_date]['nav']
+                            if present[h_code][i]:
+                                h_curr_nav = navs[h_code][rows[h_code][i]]
                             
                             h_hold_days = (curr_date - pd.to_datetime(info['entry_date'])).days
                             fee_rate = 0.015 if h_hold_days < 7 else 0.0
@@ -875,9 +1374,9 @@ class PortfolioBacktester:
                 if code in rebalance_sells: continue
                 info = holdings[code]
                 df = self.data_map.get(code)
-                if df is None or curr_date not in df.index: continue
+                if df is None or not present[code][i]: continue
                 
-                df_slice = df.loc[:curr_date]
+                df_slice = df.iloc[:rows[code][i] + 1]
                 if len(df_slice) < 130: continue
                 current_nav = df_slice['nav'].iloc[-1]
                 
@@ -937,12 +1436,8 @@ class PortfolioBacktester:
             # --- 4. 买入逻辑 (筛选强动能品种) ---
             current_hold_val = 0
             for h_code, h in holdings.items():
-                df = self.data_map.get(h_code)
-                if df is not None and curr_date in df.index:
-                    current_hold_val += h['shares'] * df.loc[curr_date]['nav']
-                elif df is not None:
-                        idx = df.index.get_indexer([curr_date], method='pad')[0]
-                        if idx != -1: current_hold_val += h['shares'] * df.iloc[idx]['nav']
+                idx = rows[h_code][i] if h_code in rows else -1
+                if idx != -1: current_hold_val += h['shares'] * navs[h_code][idx]
             current_equity = capital + sum([r['amount'] for r in receivables]) + current_hold_val
 
             if len(holdings) < max_holdings and capital > 2000:
@@ -950,14 +1445,12 @@ class PortfolioBacktester:
                 held_clean_names = {re.sub(r'[A-Z]$', '', h['name']) for h in holdings.values()}
                 
                 momentum_scores = []
-                for code, df in self.data_map.items():
-                    if curr_date not in df.index: continue
-                    idx = df.index.get_indexer([curr_date], method='nearest')[0]
+                for code in self.data_map:
+                    if not present[code][i]: continue
+                    idx = rows[code][i]
                     if idx < MOMENTUM_WINDOW: continue
-                    past_slice = df.iloc[idx-MOMENTUM_WINDOW : idx+1]
-                    if past_slice.empty: continue
-                    start_p = past_slice['nav'].iloc[0]
-                    end_p = past_slice['nav'].iloc[-1]
+                    start_p = navs[code][idx - MOMENTUM_WINDOW]
+                    end_p = navs[code][idx]
                     mom_score = (end_p - start_p) / start_p
                     momentum_scores.append({'code': code, 'mom': mom_score})
                 
@@ -970,8 +1463,8 @@ class PortfolioBacktester:
                 for code, df in self.data_map.items():
                     if code in holdings: continue
                     if code not in whitelist_codes: continue 
-                    if curr_date not in df.index: continue
-                    df_slice = df.loc[:curr_date]
+                    if not present[code][i]: continue
+                    df_slice = df.iloc[:rows[code][i] + 1]
                     if len(df_slice) < 130: continue
                     sig = WaveEngine.analyze_structure(df_slice, [])
                     if sig['status'] == 'Buy' and sig['score'] >= 80:
@@ -1054,14 +1547,15 @@ class PortfolioManager:
         self.conn = st.connection("supabase", type=SupabaseConnection)
         self.user_id = "default_user" 
         
-        # 2. 从云端加载数据
+        # 2. 从云端加载数据 (持仓按代码建立索引: code -> Holding)
+        self.holdings: Dict[str, Holding] = {}
         self.data = self.load()
         
         # 3. 每次初始化时，尝试结算在途订单
         self.settle_orders()
 
     def load(self):
-        """从 Supabase 云端读取数据"""
+        """从 Supabase 云端读取数据；持仓解析为 Holding 并刷新 self.holdings 索引"""
         try:
             res = self.conn.table("trader_storage").select("portfolio_data").eq("id", self.user_id).execute()
             if res.data and len(res.data) > 0:
@@ -1070,24 +1564,48 @@ class PortfolioManager:
                 if "pending_orders" not in data: data["pending_orders"] = []
                 if "history" not in data: data["history"] = []
                 if "capital" not in data: data["capital"] = DEFAULT_CAPITAL
-                if "holdings" not in data: data["holdings"] = []
-                return data
             else:
-                return {"capital": DEFAULT_CAPITAL, "holdings": [], "history": [], "pending_orders": []}
+                data = {"capital": DEFAULT_CAPITAL, "history": [], "pending_orders": []}
         except Exception as e:
             st.error(f"☁️ 云端数据读取失败: {e}")
-            return {"capital": DEFAULT_CAPITAL, "holdings": [], "history": [], "pending_orders": []}
+            data = {"capital": DEFAULT_CAPITAL, "history": [], "pending_orders": []}
+
+        self.holdings = {}
+        for raw in data.pop("holdings", None) or []:
+            h = Holding.from_dict(raw)
+            if h.code in self.holdings:
+                # 重复代码的旧数据：批次合并到同一持仓
+                for lot in h.lots: self.holdings[h.code].lots.append(lot.date, lot.shares, lot.cost_per_share, lot.fee_paid)
+            else:
+                self.holdings[h.code] = h
+        return data
+
+    def to_payload(self):
+        """序列化为云端 JSON (holdings 仍为原有的列表结构)"""
+        return {**self.data, "holdings": [h.to_dict() for h in self.holdings.values()]}
 
     def save(self):
         """同步到 Supabase 云端"""
         try:
             self.conn.table("trader_storage").upsert({
                 "id": self.user_id,
-                "portfolio_data": self.data
+                "portfolio_data": self.to_payload()
             }).execute()
         except Exception as e:
             st.error(f"❌ 云端同步失败: {e}")
 
+    def revalue(self, price_map: Dict[str, float]) -> np.ndarray:
+        """批量重估持仓市值 (与 self.holdings 顺序一致)，缺少报价的按成本价计"""
+        hs = list(self.holdings.values())
+        shares = np.fromiter((h.total_shares for h in hs), dtype=float, count=len(hs))
+        costs = np.fromiter((h.avg_cost for h in hs), dtype=float, count=len(hs))
+        prices = np.array([price_map.get(h.code, np.nan) for h in hs], dtype=float)
+        return shares * np.where(np.isnan(prices), costs, prices)
+
+    def invested_cost(self) -> float:
+        """持仓总成本"""
+        return float(sum(h.lots.cost_basis for h in self.holdings.values()))
+
     def settle_orders(self):
         """真实的结算逻辑：锁定下单成本"""
         today = get_bj_time().date()
@@ -1145,34 +1663,19 @@ class PortfolioManager:
         price = order.get('cost', 0.0) # 下单时的成本
         date_str = order['date']
         
-        existing_idx = -1
-        for i, h in enumerate(self.data['holdings']):
-            if h['code'] == code: 
-                existing_idx = i
-                break
-        
-        new_lot = {"date": date_str, "shares": shares, "cost_per_share": price}
-        
-        if existing_idx >= 0:
-            existing = self.data['holdings'][existing_idx]
-            total_shares_old = existing['shares']
-            total_cost_old = existing['cost'] * total_shares_old
-            new_total_shares = total_shares_old + shares
-            existing['shares'] = new_total_shares
-            existing['cost'] = (total_cost_old + (shares * price)) / new_total_shares
-            if "lots" not in existing: existing["lots"] = []
-            existing['lots'].append(new_lot)
+        existing = self.holdings.get(code)
+        if existing is not None:
+            # 加仓：新批次并入批次簿，均价由批次数组实时推导
+            existing.lots.append(date_str, shares, price)
         else:
-            self.data['holdings'].append({
-                "code": code, "name": order['name'], 
-                "shares": shares, "cost": price, 
-                "date": date_str, 
-                "stop_loss": order.get('stop_loss', 0), 
-                "target": order.get('target', 0), 
-                "partial_sold": False,
-                "lots": [new_lot],
-                "highest_nav": price
-            })
+            self.holdings[code] = Holding(
+                code=code, name=order['name'],
+                lots=LotBook([date_str], [shares], [price]),
+                stop_loss_price=order.get('stop_loss', 0),
+                target_price=order.get('target', 0),
+                highest_nav=price,
+                entry_date=date_str
+            )
 
     def execute_buy(self, code, name, price, amount, stop_loss, target, reason):
         if self.data['capital'] < amount: return False, "可用资金不足"
@@ -1198,51 +1701,22 @@ class PortfolioManager:
 
     def execute_sell(self, code, price, reason, force=False):
         """卖出逻辑：包含惩罚费计算，并将记录同步到云端、流水及飞书"""
-        idx = -1
-        for i, h in enumerate(self.data['holdings']):
-            if h['code'] == code: 
-                idx = i
-                break
-        
-        if idx == -1: 
+        h = self.holdings.get(code)
+        if h is None: 
             return False, "持仓中未找到该基金"
         
-        # 锁定当前持仓对象
-        h = self.data['holdings'][idx]
-        fund_name = h['name']  # 提前取出名称，防止 pop 后引用报错
-        
-        total_shares_to_sell = h['shares'] 
-        lots = h.get('lots', [{"date": "2020-01-01", "shares": total_shares_to_sell, "cost_per_share": h['cost']}])
-        lots.sort(key=lambda x: x['date']) 
-        
-        remaining_sell = total_shares_to_sell
-        total_revenue, total_fee, total_cost_basis = 0.0, 0.0, 0.0
-        today = get_bj_time().date()
+        fund_name = h.name
+        lots = h.lots
         
-        temp_lots = [lot.copy() for lot in lots]
-        used_lots_indices, penalty_shares = [], 0 
-        
-        # 1. 核心计算逻辑
-        for i, lot in enumerate(temp_lots):
-            if remaining_sell <= 0: break
-            can_sell = min(remaining_sell, lot['shares'])
-            buy_date = datetime.datetime.strptime(lot['date'].split(' ')[0], "%Y-%m-%d").date()
-            hold_days = (today - buy_date).days
-            
-            # 惩罚费判断
-            fee_rate = 0.015 if hold_days < 7 else 0.0
-            if fee_rate > 0: penalty_shares += can_sell
-            
-            fee_val = (can_sell * price) * fee_rate
-            total_revenue += (can_sell * price) - fee_val
-            total_fee += fee_val
-            total_cost_basis += can_sell * lot['cost_per_share']
-            remaining_sell -= can_sell
-            
-            if abs(can_sell - lot['shares']) < 1e-6: 
-                used_lots_indices.append(i) 
-            else: 
-                temp_lots[i]['shares'] -= can_sell
+        # 1. 核心计算逻辑 (FIFO 整批向量化)
+        taken = lots.fifo_take(lots.total_shares)
+        penalty = lots.hold_days(get_bj_time().date()) < 7   # 惩罚费判断
+        gross = taken * price
+        fees = np.where(penalty, gross * 0.015, 0.0)
+        total_fee = float(fees.sum())
+        total_revenue = float(gross.sum()) - total_fee
+        total_cost_basis = float(taken @ lots.costs)
+        penalty_shares = float(taken[penalty].sum())
         
         # 2. 软确认
         if penalty_shares > 0 and not force:
@@ -1256,14 +1730,9 @@ class PortfolioManager:
         pnl_pct = pnl_val / total_cost_basis if total_cost_basis > 0 else 0
         
         # 5. 更新持仓数据
-        new_lots = [lot for i, lot in enumerate(temp_lots) if i not in used_lots_indices]
-        if not new_lots: 
-            self.data['holdings'].pop(idx)
-        else:
-            h['lots'] = new_lots
-            h['shares'] = sum(l['shares'] for l in new_lots)
-            h['cost'] = sum(l['shares'] * l['cost_per_share'] for l in new_lots) / h['shares']
-            self.data['holdings'][idx] = h
+        lots.consume(taken)
+        if not len(lots): 
+            del self.holdings[code]
             
         # 6. 记录历史流水
         fee_note = f" (含惩罚费 ¥{total_fee:.2f})" if total_fee > 0 else ""
@@ -1333,26 +1802,26 @@ class PortfolioManager:
         dead_positions = []
         today_dt = get_bj_time().date()
         
-        for h in self.data['holdings']:
+        for h in self.holdings.values():
             # 获取最新价格
-            curr_p, _, _, _ = DataService.get_smart_price(h['code'], h['cost'])
+            cost = h.avg_cost
+            curr_p, _, _, _ = DataService.get_smart_price(h.code, cost, hedge=True)
             
-            # 计算最早买入日期
+            # 计算最早买入日期 (批次簿按日期排序，首批即最早)
             first_buy = today_dt
-            if h.get('lots'):
-                first_date_str = h['lots'][0]['date'].split(' ')[0]
-                first_buy = datetime.datetime.strptime(first_date_str, "%Y-%m-%d").date()
-            elif 'date' in h:
+            if len(h.lots):
+                first_buy = datetime.datetime.strptime(h.lots[0].date.split(' ')[0], "%Y-%m-%d").date()
+            elif h.entry_date:
                  # 兼容旧数据
-                first_buy = datetime.datetime.strptime(h['date'].split(' ')[0], "%Y-%m-%d").date()
+                first_buy = datetime.datetime.strptime(h.entry_date.split(' ')[0], "%Y-%m-%d").date()
             
             held_days = (today_dt - first_buy).days
-            pnl_pct = (curr_p - h['cost']) / h['cost'] if h['cost'] > 0 else 0
+            pnl_pct = (curr_p - cost) / cost if cost > 0 else 0
             
             if held_days > DEAD_MONEY_DAYS and abs(pnl_pct) < DEAD_MONEY_THRESHOLD:
                 dead_positions.append({
-                    "code": h['code'],
-                    "name": h['name'],
+                    "code": h.code,
+                    "name": h.name,
                     "days": held_days,
                     "pnl": pnl_pct,
                     "price": curr_p
@@ -1525,9 +1994,9 @@ def render_dashboard():
                 is_holding = False
                 clean_target = re.sub(r'[A-Z]$', '', r['name'])
                 duplicate_warning = ""
-                for h in pm.data['holdings']:
-                    if h['code'] == r['code']: is_holding = True
-                    clean_exist = re.sub(r'[A-Z]$', '', h['name'])
+                if r['code'] in pm.holdings: is_holding = True
+                for h in pm.holdings.values():
+                    clean_exist = re.sub(r'[A-Z]$', '', h.name)
                     if clean_exist == clean_target: duplicate_warning = " (同名持仓)"
                 
                 score = r['res']['score']
@@ -1535,7 +2004,7 @@ def render_dashboard():
                 
                 # === 核心逻辑: ATR 波动率定仓法 ===
                 # 假设总账户权益（本金+持仓） * 1% 作为单笔风险金
-                total_equity = pm.data['capital'] + sum([h['shares'] * h['cost'] for h in pm.data['holdings']])
+                total_equity = pm.data['capital'] + pm.invested_cost()
                 risk_amt = total_equity * RISK_PER_TRADE
                 atr_val = r['res'].get('atr', 0)
                 
@@ -1597,8 +2066,9 @@ def render_dashboard():
         alerts = []
         bj_now = get_bj_time() # 获取当前北京时间
         
-        for h in pm.data['holdings']:
-            curr_p, df, used_est, _ = DataService.get_smart_price(h['code'], h['cost'])
+        for h in pm.holdings.values():
+            h_cost = h.avg_cost
+            curr_p, df, used_est, _ = DataService.get_smart_price(h.code, h_cost, hedge=True)
             
             # --- 核心逻辑：在推送中加入波浪诊断 ---
             if not df.empty:
@@ -1608,16 +2078,17 @@ def render_dashboard():
                 
                 # 1. 检查诊断卖出信号
                 if res['status'] == 'Sell':
-                    alerts.append(f"🚨 **波浪卖点**: {h['name']} ({res['desc']})")
+                    alerts.append(f"🚨 **波浪卖点**: {h.name} ({res['desc']})")
             
             # 2. 原有的硬件止损检查
-            if h.get('stop_loss', 0) > 0 and curr_p < h['stop_loss']:
-                alerts.append(f"🔴 **破位止损**: {h['name']} (现价{curr_p:.4f} < 止损{h['stop_loss']:.4f})")
+            if h.stop_loss_price > 0 and curr_p < h.stop_loss_price:
+                alerts.append(f"🔴 **破位止损**: {h.name} (现价{curr_p:.4f} < 止损{h.stop_loss_price:.4f})")
             
             # 3. 移动止损检查
-            dd = (h.get('highest_nav', h['cost']) - curr_p) / h.get('highest_nav', h['cost'])
-            if dd > TRAILING_STOP_PCT and curr_p > h['cost'] * TRAILING_STOP_ACTIVATE:
-                alerts.append(f"🟠 **回撤止损**: {h['name']} (高点回撤{dd:.1%})")
+            h_peak = h.highest_nav or h_cost
+            dd = (h_peak - curr_p) / h_peak
+            if dd > TRAILING_STOP_PCT and curr_p > h_cost * TRAILING_STOP_ACTIVATE:
+                alerts.append(f"🟠 **回撤止损**: {h.name} (高点回撤{dd:.1%})")
 
         # 推送按钮执行
         if alerts:
@@ -1638,7 +2109,7 @@ def render_dashboard():
         
         for i, item in enumerate(USER_PORTFOLIO_CONFIG):
             # 1. 获取智能价格和历史 df
-            curr_price, df, used_est, _ = DataService.get_smart_price(item['code'], item['cost'])
+            curr_price, df, used_est, _ = DataService.get_smart_price(item['code'], item['cost'], hedge=True)
             
             # 数据防御性检查：如果没有 nav 列，跳过
             if df.empty or 'nav' not in df.columns:
@@ -1671,7 +2142,8 @@ def render_dashboard():
             else:
                 df_calc = df
             df_calc = IndicatorEngine.calculate_indicators(df_calc)
-            pivots = WaveEngine.zig_zag(df_calc['nav'][-150:]) 
+            # 信号仍取最近 150 根 (含估值K线) 的拐点：zig-zag 与起点有关，不能用全历史索引代替
+            pivots = WaveEngine.zig_zag(df_calc['nav'][-150:])
             res = WaveEngine.analyze_structure(df_calc, pivots)
             
             # 5. 【策略判定】移动止盈
@@ -1699,14 +2171,16 @@ def render_dashboard():
                     st.markdown(f"### 波浪建议: :{advice_color}[{res['status']}]")
                     st.write(f"**分析**: {res['desc']} (疑似入场日: {inferred_buy_date.date()})")
                 
-                # 绘图
-                fig = plot_wave_chart(df_calc.iloc[-120:], pivots, f"{item['name']} 结构图", cost=item['cost'])
+                # 绘图 (默认尺度与信号同一组拐点，其他尺度查拐点索引)
+                scale = st.select_slider("波段尺度", options=PivotIndex.DEVIATIONS, value=0.05, format_func=lambda d: f"{d:.0%}", help=SCALE_HELP, key=f"diag_scale_{item['code']}_{i}")
+                chart_pivots = pivots if scale == 0.05 else DataService.chart_pivots(item['code'], df, df_calc, scale, used_est)
+                fig = plot_wave_chart(df_calc.iloc[-120:], chart_pivots, f"{item['name']} 结构图", cost=item['cost'])
                 st.plotly_chart(fig, use_container_width=True, key=f"diag_chart_{item['code']}_{i}")
 
     with tab2:
         st.header("💼 模拟交易台")
         pm.settle_orders() # 处理 T+1
-        holdings = pm.data.get('holdings', [])
+        holdings = list(pm.holdings.values())
         pending = pm.data.get('pending_orders', [])
         history = pm.data.get('history', [])
 
@@ -1720,7 +2194,8 @@ def render_dashboard():
             with st.spinner(f"正在扫描 {len(holdings)} 个持仓的实时风险..."):
                 for h in holdings:
                     # 使用智能价格获取
-                    curr_price, df, used_est, _ = DataService.get_smart_price(h['code'], h['cost'])
+                    h_cost = h.avg_cost
+                    curr_price, df, used_est, _ = DataService.get_smart_price(h.code, h_cost, hedge=True)
                     
                     if not df.empty:
                         if used_est:
@@ -1733,17 +2208,18 @@ def render_dashboard():
                         res = WaveEngine.analyze_structure(df_calc, pivots)
                         
                         triggers = []
-                        struct_stop = h.get('stop_loss', 0)
+                        struct_stop = h.stop_loss_price
                         if struct_stop > 0 and curr_price < struct_stop: triggers.append(f"跌破结构 (现价{curr_price:.4f} < 止损{struct_stop:.4f})")
-                        hard_stop_price = h['cost'] * (1 - FUND_STOP_LOSS)
+                        hard_stop_price = h_cost * (1 - FUND_STOP_LOSS)
                         if curr_price < hard_stop_price: triggers.append(f"触及硬止损 (亏损 > {FUND_STOP_LOSS:.1%})")
-                        if curr_price > h.get('highest_nav', 0): h['highest_nav'] = curr_price
-                        dd = (h.get('highest_nav', h['cost']) - curr_price) / h.get('highest_nav', h['cost'])
-                        if dd > TRAILING_STOP_PCT and curr_price > h['cost'] * TRAILING_STOP_ACTIVATE: triggers.append(f"移动止损触发 (高点回撤 {dd:.2%})")
+                        if curr_price > h.highest_nav: h.highest_nav = curr_price
+                        h_peak = h.highest_nav or h_cost
+                        dd = (h_peak - curr_price) / h_peak
+                        if dd > TRAILING_STOP_PCT and curr_price > h_cost * TRAILING_STOP_ACTIVATE: triggers.append(f"移动止损触发 (高点回撤 {dd:.2%})")
                         if res['status'] == 'Sell': triggers.append(f"波浪卖点: {res['desc']}")
                         
                         if triggers:
-                            sell_alerts.append({"code": h['code'], "name": h['name'], "price": curr_price, "reasons": triggers, "time": now_str})
+                            sell_alerts.append({"code": h.code, "name": h.name, "price": curr_price, "reasons": triggers, "time": now_str})
 
         with monitor_container:
             if not sell_alerts: st.success(f"✅ 持仓风险扫描安全 ({now_str})", icon="🛡️")
@@ -1769,28 +2245,30 @@ def render_dashboard():
         with col_health_1:
             with st.expander("🔥 持仓相关性热力图 (避雷针)", expanded=False):
                 st.info("💡 检查是否存在“假分散”。如果您买了5只基金，但颜色都是深红色（相关性>0.9），说明风险极度集中！")
+                with_pool = st.checkbox("对比候选池 (买入前检查分散度)", key="corr_with_pool")
                 if st.button("生成热力图"):
-                    if len(holdings) < 2:
+                    if len(holdings) < 2 and not with_pool:
                         st.warning("持仓少于2只，无法计算相关性.")
                     else:
-                        with st.spinner("正在下载历史数据计算相关性..."):
-                            df_corr_list = []
-                            for h in holdings:
-                                df_tmp = DataService.fetch_nav_history(h['code'])
-                                if not df_tmp.empty:
-                                    df_tmp = df_tmp.iloc[-250:]
-                                    s_pct = df_tmp['nav'].pct_change()
-                                    s_pct.name = h['name']
-                                    df_corr_list.append(s_pct)
+                        with st.spinner("正在计算相关性..."):
+                            names = {h.code: h.name for h in holdings}
+                            hold_codes = list(names)
+                            pool = DataService.get_market_wide_pool() if "全市场" in scan_mode else STATIC_OTF_POOL
+                            cand_codes = [f['code'] for f in pool if f['code'] not in names] if with_pool else []
+                            for f in pool: names.setdefault(f['code'], f['name'])
+                            corr_all = DataService.get_correlation(hold_codes + cand_codes, scope="pool" if with_pool else "holdings")
+                            if with_pool and hold_codes:
+                                # 行 = 持仓，列 = 候选 (按与持仓的最高相关性升序，越靠左越能分散风险)
+                                corr_matrix = corr_all.loc[hold_codes, cand_codes].dropna(axis=1, how='all')
+                                corr_matrix = corr_matrix[corr_matrix.max().sort_values().index]
+                            else:
+                                corr_matrix = corr_all.dropna(how='all').dropna(axis=1, how='all')
                             
-                            if df_corr_list:
-                                df_corr_all = pd.concat(df_corr_list, axis=1).dropna()
-                                corr_matrix = df_corr_all.corr()
-                                
+                            if not corr_matrix.empty:
                                 fig_corr = go.Figure(data=go.Heatmap(
                                     z=corr_matrix.values,
-                                    x=corr_matrix.columns,
-                                    y=corr_matrix.index,
+                                    x=[names[c] for c in corr_matrix.columns],
+                                    y=[names[c] for c in corr_matrix.index],
                                     colorscale='RdBu_r', 
                                     zmin=-1, zmax=1
                                 ))
@@ -1806,40 +2284,28 @@ def render_dashboard():
                     if not holdings:
                         st.warning("暂无持仓。")
                     else:
-                        progress_doc = st.progress(0, text="计算市场基准...")
                         pool = DataService.get_market_wide_pool() if "全市场" in scan_mode else STATIC_OTF_POOL
-                        market_moms = []
-                        sample_pool = pool[:50]
-                        for idx, fund in enumerate(sample_pool):
-                            df = DataService.fetch_nav_history(fund['code'])
-                            if len(df) > 120:
-                                p_now = df['nav'].iloc[-1]; p_old = df['nav'].iloc[-120]
-                                market_moms.append((p_now - p_old)/p_old)
-                            progress_doc.progress((idx+1)/len(sample_pool) * 0.5)
-
-                        if market_moms:
-                            market_moms.sort(reverse=True)
-                            top_30_cutoff = market_moms[int(len(market_moms)*0.3)]
+                        # 全池 120 日动能分布 (夜间特征库，按小时缓存)
+                        with st.spinner("计算市场动能分布..."):
+                            dist = DataService.get_momentum_distribution(tuple(f['code'] for f in pool), 120)
+
+                        if len(dist):
+                            top_30_cutoff = dist.cutoff(0.3)
                             
                             fig = go.Figure()
-                            fig.add_trace(go.Histogram(x=market_moms, name='市场分布', nbinsx=20, marker_color='#90CAF9', opacity=0.6))
+                            fig.add_trace(go.Histogram(x=dist.values, name='市场分布', nbinsx=20, marker_color='#90CAF9', opacity=0.6))
                             
                             for idx, h in enumerate(holdings):
-                                df = DataService.fetch_nav_history(h['code'])
-                                mom = -999
-                                if len(df) > 120:
-                                    p_now = df['nav'].iloc[-1]; p_old = df['nav'].iloc[-120]
-                                    mom = (p_now - p_old)/p_old
+                                mom = DataService.get_momentum(h.code, 120)
+                                if mom is None: mom = -999
                                 
                                 line_color = '#FF5252' if mom < top_30_cutoff else '#00E676'
                                 fig.add_vline(x=mom, line_width=2, line_dash="solid", line_color=line_color)
                                 y_pos = 2 + (idx % 3) * 1.5 
-                                fig.add_annotation(x=mom, y=y_pos, text=h['name'][:4], showarrow=True, arrowhead=1, ax=20, ay=-20)
-                                progress_doc.progress(0.5 + (idx+1)/len(holdings) * 0.5)
+                                fig.add_annotation(x=mom, y=y_pos, text=f"{h.name[:4]} {dist.percentile(mom):.0%}", showarrow=True, arrowhead=1, ax=20, ay=-20)
                             
                             fig.add_vline(x=top_30_cutoff, line_width=2, line_dash="dash", line_color="orange", annotation_text="Top 30%")
-                            fig.update_layout(title="持仓 vs 市场动能", xaxis_title="120日涨幅", yaxis_title="数量", showlegend=False, height=400, margin=dict(l=0, r=0, t=30, b=0))
-                            progress_doc.empty()
+                            fig.update_layout(title=f"持仓 vs 市场动能 (全池 {len(dist)} 只)", xaxis_title="120日涨幅", yaxis_title="数量", showlegend=False, height=400, margin=dict(l=0, r=0, t=30, b=0))
                             st.plotly_chart(fig, use_container_width=True)
                         else:
                             st.error("数据不足")
@@ -1848,11 +2314,11 @@ def render_dashboard():
         
         # === 核心：综合盈亏统计 (实盈 + 浮盈) ===
         
-        # 1. 计算当前所有持仓的浮动盈亏
-        total_holdings_pnl = 0
-        for h in holdings:
-            curr_p, _, _, _ = DataService.get_smart_price(h['code'], h['cost'])
-            total_holdings_pnl += (curr_p - h['cost']) * h['shares']
+        # 1. 计算当前所有持仓的浮动盈亏 (一次取价，批量重估)
+        price_map = {h.code: DataService.get_smart_price(h.code, h.avg_cost, hedge=True)[0] for h in holdings}
+        hold_vals = pm.revalue(price_map)
+        total_invested_cost = pm.invested_cost()
+        total_holdings_pnl = float(hold_vals.sum()) - total_invested_cost
 
         # 2. 获取历史已平仓的累计盈亏 (包含交银亏损)
         history_pnl = sum([h.get('pnl', 0) for h in history if h.get('pnl', 0) != 0])
@@ -1861,7 +2327,6 @@ def render_dashboard():
         total_combined_pnl = history_pnl + total_holdings_pnl
         
         # 计算投入成本基数
-        total_invested_cost = sum(h['shares'] * h['cost'] for h in holdings)
         total_pnl_pct = (total_combined_pnl / (total_invested_cost + 1e-6))
 
         # --- UI 展示：实战战报 ---
@@ -1876,7 +2341,7 @@ def render_dashboard():
         st.divider()
 
         # 资产分布卡片（用于核对银行卡余额）
-        total_hold_val = sum(h['shares'] * DataService.get_smart_price(h['code'], h['cost'])[0] for h in holdings)
+        total_hold_val = float(hold_vals.sum())
         pending_val = sum([p['amount'] for p in pending])
         total_assets_display = pm.data['capital'] + total_hold_val + pending_val
         
@@ -1890,13 +2355,8 @@ def render_dashboard():
         c_left, c_right = st.columns([1, 2])
         with c_left:
             st.subheader("📊 资产状态")
-            hold_vals = []
-            for h in holdings:
-                curr_p, _, _, _ = DataService.get_smart_price(h['code'], h['cost'])
-                hold_vals.append(h['shares'] * curr_p)
-
-            labels = ['现金', '在途'] + [h['name'] for h in holdings]
-            values = [pm.data['capital'], pending_val] + hold_vals
+            labels = ['现金', '在途'] + [h.name for h in holdings]
+            values = [pm.data['capital'], pending_val] + hold_vals.tolist()
             plot_data = [(l, v) for l, v in zip(labels, values) if v > 0]
             if plot_data:
                 fig_pie = go.Figure(data=[go.Pie(labels=[x[0] for x in plot_data], values=[x[1] for x in plot_data], hole=.4)])
@@ -1970,7 +2430,9 @@ def render_dashboard():
             if not holdings: st.caption("暂无持仓")
             else:
                 for h in holdings:
-                    curr_price, df, used_est, _ = DataService.get_smart_price(h['code'], h['cost'])
+                    h_cost = h.avg_cost
+                    h_shares = h.total_shares
+                    curr_price, df, used_est, _ = DataService.get_smart_price(h.code, h_cost, hedge=True)
                     
                     can_add = False; add_reason = ""
                     res = {'status': 'Unknown', 'desc': '', 'score': 0}
@@ -1981,27 +2443,23 @@ def render_dashboard():
                             df_calc = pd.concat([df, new_row])
                         else: df_calc = df
                         df_calc = IndicatorEngine.calculate_indicators(df_calc)
-                        pivots = WaveEngine.zig_zag(df_calc['nav'][-150:]) 
+                        pivots = WaveEngine.zig_zag(df_calc['nav'][-150:])
                         res = WaveEngine.analyze_structure(df_calc, pivots)
-                        pnl_pct = (curr_price - h['cost']) / h['cost']
+                        pnl_pct = (curr_price - h_cost) / h_cost
                         if pnl_pct > 0.03 and res['status'] == 'Buy' and res['score'] >= 80:
                             can_add = True; add_reason = f"浮盈安全垫({pnl_pct:.1%}) + 趋势延续({res['pattern']})"
 
-                    mkt_val = h['shares'] * curr_price
-                    pnl_val = mkt_val - (h['shares'] * h['cost'])
-                    pnl_pct = (curr_price - h['cost']) / h['cost'] if h['cost'] > 0 else 0
+                    mkt_val = h_shares * curr_price
+                    pnl_val = mkt_val - (h_shares * h_cost)
+                    pnl_pct = (curr_price - h_cost) / h_cost if h_cost > 0 else 0
                     
-                    lots = h.get('lots', [])
-                    penalty_shares = 0
-                    today_dt = get_bj_time().date()
-                    for lot in lots:
-                        l_date = datetime.datetime.strptime(lot['date'].split(' ')[0], "%Y-%m-%d").date()
-                        if (today_dt - l_date).days < 7: penalty_shares += lot['shares']
+                    lots = h.lots
+                    penalty_shares = float(lots.shares[lots.hold_days(get_bj_time().date()) < 7].sum())
                     
                     with st.container():
                         c1, c2, c3, c4 = st.columns([3, 2, 2, 2])
-                        c1.markdown(f"**{h['name']}**")
-                        c1.caption(f"{h['code']} | 批次: {len(lots)}")
+                        c1.markdown(f"**{h.name}**")
+                        c1.caption(f"{h.code} | 批次: {len(lots)}")
                         if can_add: c1.success(f"🔥 适合加仓: {add_reason}", icon="📈")
                         if penalty_shares > 0: c1.warning(f"⚠️ {penalty_shares:.0f}份不满7天", icon="⏳")
                         c2.metric("持仓市值", f"¥{mkt_val:,.0f}")
@@ -2012,28 +2470,30 @@ def render_dashboard():
                             # 1. 加仓按钮 (此处已修正变量名错误)
                             add_amt_sugg = total_assets_display * 0.10
                             add_amt = min(pm.data['capital'], add_amt_sugg)
-                            if col_add.button("➕", key=f"add_{h['code']}", help=f"建议加仓 ¥{add_amt:.0f}"):
+                            if col_add.button("➕", key=f"add_{h.code}", help=f"建议加仓 ¥{add_amt:.0f}"):
                                 if pm.data['capital'] < 100: st.error("现金不足！")
                                 else:
-                                    suc, msg = pm.execute_buy(h['code'], h['name'], curr_price, add_amt, res.get('stop_loss', 0), res.get('target', 0), f"浮盈加仓 (+{pnl_pct:.1%})")
+                                    suc, msg = pm.execute_buy(h.code, h.name, curr_price, add_amt, res.get('stop_loss', 0), res.get('target', 0), f"浮盈加仓 (+{pnl_pct:.1%})")
                                     if suc: st.toast(f"✅ 已提交！"); time.sleep(1); st.rerun()
                             
                             # 2. 正常卖出按钮
-                            if col_sell.button("💰", key=f"sell_{h['code']}", help="卖出并结算资金到现金账户"):
-                                suc, msg = pm.execute_sell(h['code'], curr_price, "手动卖出", force=True)
+                            if col_sell.button("💰", key=f"sell_{h.code}", help="卖出并结算资金到现金账户"):
+                                suc, msg = pm.execute_sell(h.code, curr_price, "手动卖出", force=True)
                                 if suc: st.success(msg); time.sleep(1); st.rerun()
                             
                             # 3. 彻底删除按钮
-                            if col_del.button("🗑️", key=f"raw_del_{h['code']}", help="彻底删除此记录 (不计入收益，不退回资金)"):
-                                pm.data['holdings'].pop(holdings.index(h))
+                            if col_del.button("🗑️", key=f"raw_del_{h.code}", help="彻底删除此记录 (不计入收益，不退回资金)"):
+                                del pm.holdings[h.code]
                                 pm.save() 
-                                st.toast(f"🗑️ {h['name']} 已从云端彻底抹除")
+                                st.toast(f"🗑️ {h.name} 已从云端彻底抹除")
                                 time.sleep(1)
                                 st.rerun()
                         
-                        with st.expander(f"📉 {h['name']} 走势与结构分析"):
+                        with st.expander(f"📉 {h.name} 走势与结构分析"):
                             if not df.empty:
-                                fig = plot_wave_chart(df_calc.iloc[-120:], pivots, f"{h['name']} 结构图", cost=h['cost'])
+                                scale = st.select_slider("波段尺度", options=PivotIndex.DEVIATIONS, value=0.05, format_func=lambda d: f"{d:.0%}", help=SCALE_HELP, key=f"hold_scale_{h.code}")
+                                chart_pivots = pivots if scale == 0.05 else DataService.chart_pivots(h.code, df, df_calc, scale, used_est)
+                                fig = plot_wave_chart(df_calc.iloc[-120:], chart_pivots, f"{h.name} 结构图", cost=h_cost)
                                 st.plotly_chart(fig, use_container_width=True)
                                 st.info(f"波浪分析: {res['desc']}")
                             else:
@@ -2323,4 +2783,6 @@ def render_dashboard():
                     st.line_chart(df.set_index('date')[['val', 'bench_val']].rename(columns={'val':'我的策略', 'bench_val':'沪深300'}))
 
 if __name__ == "__main__":
-    render_dashboard()
+    start_cache_warmer()
+    with em_transport.lane(client=em_transport.streamlit_session_id()):
+        render_dashboard()
@@ -0,0 +1,311 @@
+"""
+波浪结构的纯计算部分 (rt_earn 页面与扫描工作进程共用)。
+
+指标、拐点、推动浪校验、动态状态与 1-2浪回测都只依赖传入的净值表，不碰 streamlit / 网络，
+因此可以被 ProcessPoolExecutor 的子进程直接导入；页面侧的 ElliottWaveAnalyzer 继承 WaveAnalyzer，
+只补充数据获取与按基金缓存的拐点索引。
+"""
+from typing import NamedTuple, List
+
+import numpy as np
+import pandas as pd
+from scipy.signal import argrelextrema
+
+# === 多阶拐点索引 ===
+PIVOT_MAX_ORDER = 30 # 与"波浪灵敏度"滑块上限一致
+
+def local_extrema_orders(values, max_order=PIVOT_MAX_ORDER):
+    """
+    一次扫描求出 1..max_order 各阶的严格局部极值 (与 argrelextrema 默认 clip 模式一致)。
+    返回 (high_order, low_order)：每个点作为高/低点成立的最大阶数，>= order 即为该阶拐点。
+    """
+    n = len(values)
+    locs = np.arange(n)
+    high_alive = np.ones(n, dtype=bool); low_alive = np.ones(n, dtype=bool)
+    high_order = np.zeros(n, dtype=np.int16); low_order = np.zeros(n, dtype=np.int16)
+    for shift in range(1, max_order + 1):
+        plus = values.take(locs + shift, mode='clip')
+        minus = values.take(locs - shift, mode='clip')
+        high_alive &= (values > plus) & (values > minus)
+        low_alive &= (values < plus) & (values < minus)
+        if not (high_alive.any() or low_alive.any()): break
+        high_order[high_alive] = shift; low_order[low_alive] = shift
+    return high_order, low_order
+
+class PivotIndex:
+    """
+    单只基金的多阶拐点索引：任意阶 (<= PIVOT_MAX_ORDER) 的拐点查询都是查表。
+    序列变化 (新净值 / 估值刷新) 时只重算受影响的尾部。
+    """
+    __slots__ = ('nav', 'high_order', 'low_order')
+
+    def __init__(self, nav):
+        self.nav = nav
+        self.high_order, self.low_order = local_extrema_orders(nav)
+
+    def sync(self, nav) -> 'PivotIndex':
+        """与新序列同步：未变化返回自身，否则返回只重算尾部的新索引 (不改写自身，共享中的索引可被多线程读)"""
+        k = min(len(nav), len(self.nav))
+        diff = np.flatnonzero(nav[:k] != self.nav[:k])
+        m = int(diff[0]) if len(diff) else k # 公共前缀长度
+        if m == len(nav) == len(self.nav): return self
+        # a 之前的点，其 ±max_order 邻域都落在公共前缀内
+        a = max(0, m - 1 - PIVOT_MAX_ORDER); lo = max(0, a - PIVOT_MAX_ORDER)
+        high_tail, low_tail = local_extrema_orders(nav[lo:])
+        synced = PivotIndex.__new__(PivotIndex)
+        synced.nav = nav
+        synced.high_order = np.concatenate([self.high_order[:a], high_tail[a - lo:]])
+        synced.low_order = np.concatenate([self.low_order[:a], low_tail[a - lo:]])
+        return synced
+
+    def extrema(self, order):
+        return np.flatnonzero(self.high_order >= order), np.flatnonzero(self.low_order >= order)
+
+# === 动态状态结果 ===
+class DynamicStatus(NamedTuple):
+    """analyze_dynamic_status 的结果 (兼容原有按位置解包)"""
+    status: str
+    color: str
+    reason: str
+    fib_levels: dict
+    running_high: float
+    instruction: str
+    buy_limit: float
+    buy_stop: float
+    time_windows: list
+    suggested_shares: float
+    current_price: float
+    est_pct: float
+    forecast: dict
+
+# 各分支: (状态, 颜色, 逻辑, 默认指令, 预测描述)
+STATUS_BRANCHES = [
+    ("下跌趋势", "red", "ZigZag高点确立，主跌浪风险", "观望", "弱势探底"),
+    ("浪5背离", "orange", "MACD顶背离", "观望", "高位遇阻"),
+    ("浪3主升", "blue", "强势突破，上方空间打开", "持有 / 追涨", "惯性上冲"),
+    ("强势整理", "blue", "空中加油", "持有", "高位横盘"),
+    ("正常回调", "blue", "良性洗盘", "分批买入", "支撑测试"),
+    ("深度回调", "orange", "关注0.618支撑", None, "寻找底部"),
+    ("趋势破坏", "red", "有效跌破0.618", "不宜介入", "加速下跌"),
+]
+
+
+class WaveAnalyzer:
+    """无状态的波浪分析器 (可 pickle)"""
+    def calculate_indicators(self, df):
+        if df.empty: return df
+        exp1 = df['nav'].ewm(span=12, adjust=False).mean()
+        exp2 = df['nav'].ewm(span=26, adjust=False).mean()
+        df['macd'] = exp1 - exp2
+        df['signal'] = df['macd'].ewm(span=9, adjust=False).mean()
+        df['tr'] = df['nav'].diff().abs()
+        df['atr'] = df['tr'].rolling(window=14).mean()
+        return df
+
+    def find_pivots(self, df, order=10, key=None): 
+        if df.empty: return []
+        nav = df['nav'].to_numpy(dtype=float)
+        highs_idx, lows_idx = self._extrema(nav, order, key)
+        pivots = []
+        for idx in highs_idx: pivots.append({'date': df.iloc[idx]['date'], 'nav': df.iloc[idx]['nav'], 'type': 'high', 'index': idx, 'macd': df.iloc[idx]['macd']})
+        for idx in lows_idx: pivots.append({'date': df.iloc[idx]['date'], 'nav': df.iloc[idx]['nav'], 'type': 'low', 'index': idx, 'macd': df.iloc[idx]['macd']})
+        pivots.sort(key=lambda x: x['index'])
+        if not pivots: return []
+        clean = [pivots[0]]
+        for curr in pivots[1:]:
+            if curr['type'] != clean[-1]['type']: clean.append(curr)
+        return clean
+
+    def _extrema(self, nav, order, key):
+        """order 阶严格局部极值的位置；key (基金代码, 周期) 留给页面侧按基金缓存拐点索引"""
+        return argrelextrema(nav, np.greater, order=order)[0], argrelextrema(nav, np.less, order=order)[0]
+
+    def validate_impulse_wave(self, pivots):
+        if len(pivots) < 6: return False, "点数不足", {}
+        check_seq = pivots[-6:]
+        if not (check_seq[0]['type'] == 'low' and check_seq[5]['type'] == 'high'): return False, "非上升5浪", {}
+        v = [p['nav'] for p in check_seq]
+        if v[2] <= v[0]: return False, "违规:2浪破底", {}
+        if (v[3]-v[2] <= v[1]-v[0]) and (v[3]-v[2] <= v[5]-v[4]): return False, "违规:3浪最短", {}
+        if v[4] <= v[1]: return False, "违规:4浪重叠", {}
+        return True, "标准5浪推动", {check_seq[i]['index']: str(i) for i in range(6)}
+
+    def identify_wave_structure(self, pivots):
+        is_valid, msg, labels = self.validate_impulse_wave(pivots)
+        if is_valid: return msg, labels
+        if len(pivots) >= 4:
+            p = pivots[-4:]
+            if p[0]['type'] == 'low' and p[1]['type'] == 'high' and p[2]['type'] == 'low' and p[3]['type'] == 'high':
+                if p[2]['nav'] > p[0]['nav'] and p[3]['nav'] > p[1]['nav']:
+                    return "疑似浪3主升", {p[0]['index']:"1起", p[1]['index']:"1顶", p[2]['index']:"2底", p[3]['index']:"3顶"}
+        return "调整/震荡", {}
+
+    def analyze_dynamic_status(self, df, pivots, cost, total_holding, new_holding_7d, realtime_info=None, total_capital=100000, risk_per_trade=2.0):
+        """
+        全能分析函数 (单只基金，见 analyze_dynamic_status_batch)
+        """
+        item = {"df": df, "pivots": pivots, "cost": cost, "total_holding": total_holding, "new_holding_7d": new_holding_7d, "realtime_info": realtime_info}
+        return self.analyze_dynamic_status_batch([item], total_capital, risk_per_trade)[0]
+
+    def analyze_dynamic_status_batch(self, items, total_capital=100000, risk_per_trade=2.0) -> List[DynamicStatus]:
+        """
+        批量动态分析：每只基金只取末根指标与拐点，状态 / 指令 / 仓位 / 预测在数组上一次算完。
+        items: [{"df", "pivots", "cost", "total_holding", "new_holding_7d", "realtime_info"}]
+        """
+        defaults = DynamicStatus("数据不足", "gray", "无法判断", {}, 0, "无操作", 0, 0, [], 0, 0, 0, {"target": 0, "desc": "无数据", "low": 0, "high": 0})
+        valid = [i for i, it in enumerate(items) if it['pivots'] and len(it['pivots']) >= 4]
+        results = [defaults] * len(items)
+        if not valid: return results
+
+        # --- 1. 逐只抽取末端标量 ---
+        cols = {k: [] for k in ("price", "atr", "macd", "lp_low", "lp_nav", "p2_nav", "prev_high_macd", "running_high", "hold", "old_hold", "has_rt")}
+        est_pcts = []
+        for i in valid:
+            it = items[i]; df = it['df']; pivots = it['pivots']
+            nav = df['nav'].to_numpy(dtype=float)
+            price = nav[-1]
+            atr = df['atr'].iloc[-1]
+            last_pivot = pivots[-1]
+            lp_low = last_pivot['type'] == 'low'
+            if lp_low: running_high = max(np.nanmax(nav[last_pivot['index']:]), price)
+            else: running_high = pivots[-2]['nav']
+            rt = it.get('realtime_info')
+            cols['price'].append(price)
+            cols['atr'].append(atr if not pd.isna(atr) else price * 0.015)
+            cols['macd'].append(df['macd'].iloc[-1])
+            cols['lp_low'].append(lp_low)
+            cols['lp_nav'].append(last_pivot['nav'])
+            cols['p2_nav'].append(pivots[-2]['nav'])
+            cols['prev_high_macd'].append(next((p['macd'] for p in reversed(pivots) if p['type'] == 'high'), -999))
+            cols['running_high'].append(running_high)
+            cols['hold'].append(it['total_holding'])
+            cols['old_hold'].append(max(it['total_holding'] - it['new_holding_7d'], 0))
+            cols['has_rt'].append(bool(rt))
+            # 实时数据已在 df 中融合，这里仅用于UI显示
+            est_pcts.append(rt['est_pct'] if rt and rt.get('est_nav') > 0 else 0)
+        a = {k: np.array(v, dtype=bool if k in ("lp_low", "has_rt") else float) for k, v in cols.items()}
+        price, atr, rh, lp_nav = a['price'], a['atr'], a['running_high'], a['lp_nav']
+
+        # --- 2. 斐波那契与仓位 ---
+        wave_h = np.where(a['lp_low'], rh - lp_nav, 0.0)
+        has_fib = wave_h > 0
+        f382 = np.where(has_fib, rh - wave_h * 0.382, 0.0)
+        f618 = np.where(has_fib, rh - wave_h * 0.618, 0.0) # 计划止损 & 挂单价
+        risk_amount = total_capital * (risk_per_trade / 100)
+        stop_dist = price - (f618 - atr)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shares = np.where(stop_dist > 0, risk_amount / stop_dist, 0)
+            retr = np.where(has_fib, (rh - price) / wave_h, 0)
+
+        # --- 3. 分支判定 (顺序同 STATUS_BRANCHES) ---
+        breakout = price >= rh * 0.98
+        divergence = breakout & (price > a['p2_nav']) & (a['macd'] < a['prev_high_macd'])
+        branch = np.select(
+            [~a['lp_low'], divergence, breakout, retr < 0.236, (0.236 <= retr) & (retr < 0.382), (0.382 <= retr) & (retr < 0.618)],
+            [0, 1, 2, 3, 4, 5], 6)
+        target = np.choose(branch, [price - atr, price - atr, price + atr, price + 0.5 * atr, f382, f618, price - atr])
+
+        # --- 4. 卖出指令：老仓优先，新仓 (<7天) 扣 1.5% 赎回费后仍有下行空间才卖 ---
+        is_holding = a['hold'] > 0
+        fuse = a['has_rt'] & (price < f618) & is_holding # 实时估值击穿止损线
+        with np.errstate(divide='ignore', invalid='ignore'):
+            risk_down = np.maximum((price - a['p2_nav'] * 0.9) / price, 0.03)
+            pct = np.choose(branch, [1.0, 0.5, 0, 0, 0, 0.3, 1.0])
+            risk = np.choose(branch, [risk_down, 0.0, 0, 0, 0, (price - f618) / price, (price - lp_nav) / price])
+            pct = np.where(fuse, 1.0, pct)
+            risk = np.where(fuse, (price - np.where(has_fib, lp_nav, 0)) / price, risk)
+        use_sell = fuse | (is_holding & np.isin(branch, (0, 1, 5, 6)))
+        target_sell = a['hold'] * pct
+        sell_old = np.minimum(target_sell, a['old_hold'])
+        need_new = target_sell - sell_old
+        risk_delta = risk - 0.015
+        sell_new = np.where((need_new > 0) & np.where(pct >= 0.99, (risk_delta > 0) | fuse, risk_delta > 0.005), need_new, 0)
+        total_sell = sell_old + sell_new
+
+        # --- 5. 组装结果 ---
+        for j, i in enumerate(valid):
+            status, color, reason, instruction, desc = STATUS_BRANCHES[branch[j]]
+            if branch[j] == 5: instruction = f"挂单 {f618[j]:.4f}"
+            if use_sell[j]:
+                if total_sell[j] == 0: instruction, color = "锁仓持有 (卖出不划算)", "red"
+                else:
+                    prefix = "🚨 紧急卖出" if fuse[j] else "卖出"
+                    instruction, color = f"{prefix} {total_sell[j]:.2f} 份", "red" if fuse[j] else "orange"
+            if fuse[j]:
+                status = "⚠️ 触发熔断"
+                reason = f"实时估值击穿止损线 {f618[j]:.4f}"
+            fib_levels = {}
+            if has_fib[j]:
+                fib_levels = {"High": rh[j], **{f"{r:.3f}": rh[j] - wave_h[j] * r for r in (0.236, 0.382, 0.5, 0.618)}, "Low": lp_nav[j]}
+            forecast = {"target": target[j], "desc": desc, "low": price[j] - atr[j], "high": price[j] + atr[j]}
+            results[i] = DynamicStatus(status, color, reason, fib_levels, rh[j], instruction, f618[j], rh[j] * 1.01, [], shares[j], price[j], est_pcts[j], forecast)
+        return results
+
+    def run_backtest(self, df, pivots):
+        """
+        历史 1-2浪 setup 胜率：低-高-低 且 2浪回撤 30%~70%，目标 1.5 倍浪高，止损 1浪起点。
+        首达引擎：所有 setup 一次性计算，按累计极值定位止损 / 目标的首次触达。
+        """
+        if len(pivots) < 4 or df.empty: return {"win_rate": 0, "count": 0}
+        is_low = np.array([p['type'] == 'low' for p in pivots])
+        p_nav = np.array([p['nav'] for p in pivots], dtype=float)
+        p_date = np.array([p['date'] for p in pivots], dtype='datetime64[ns]')
+        i = np.arange(2, len(pivots) - 1)
+        p1, p2, p3 = p_nav[i - 2], p_nav[i - 1], p_nav[i]
+        wave_h = p2 - p1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            retracement = (p2 - p3) / wave_h
+        ok = is_low[i - 2] & ~is_low[i - 1] & is_low[i] & (p3 > p1) & (retracement >= 0.3) & (retracement <= 0.7)
+        if not ok.any(): return {"win_rate": 0, "count": 0}
+        p3, stop, target = p3[ok], p1[ok], p3[ok] + wave_h[ok] * 1.5
+
+        nav = df['nav'].to_numpy(dtype=float)
+        n = len(nav)
+        # 每个 setup 的观察期从 p3 之后的第一根K线开始 (df 按日期升序)
+        start = np.searchsorted(df['date'].to_numpy(dtype='datetime64[ns]'), p_date[i[ok]], side='right')
+        future = np.arange(n)[None, :] >= start[:, None]
+        run_min = np.fmin.accumulate(np.where(future, nav, np.inf), axis=1)
+        run_max = np.fmax.accumulate(np.where(future, nav, -np.inf), axis=1)
+        hit_stop = run_min <= stop[:, None]
+        hit_target = run_max >= target[:, None]
+        first_stop = np.where(hit_stop.any(axis=1), hit_stop.argmax(axis=1), n)
+        first_target = np.where(hit_target.any(axis=1), hit_target.argmax(axis=1), n)
+
+        # 同一根K线先判止损
+        loss = (first_stop < n) & (first_stop <= first_target)
+        win = (first_target < n) & (first_target < first_stop)
+        # 未触达任何一侧：期末高于 p3 记为胜
+        hold_win = ~loss & ~win & (start < n) & (nav[-1] > p3)
+        wins, losses = int(win.sum() + hold_win.sum()), int(loss.sum())
+        total = wins + losses
+        win_rate = (wins / total * 100) if total > 0 else 0
+        return {"win_rate": win_rate, "count": total}
+
+
+def analyze_scan_item(args):
+    """扫描的 CPU 阶段：指标 / 拐点 / 状态 / 回测 (无共享状态；参数与结果均可 pickle，可在工作进程执行)"""
+    analyzer, m_fund, order, capital, risk, df_merged, has_rt, pivot_key = args
+    df_final = analyzer.calculate_indicators(df_merged)
+    
+    if df_final.empty: return None
+    pivots = analyzer.find_pivots(df_final, order=order, key=pivot_key)
+    is_valid, struct_msg, _ = analyzer.validate_impulse_wave(pivots)
+    
+    res = analyzer.analyze_dynamic_status(
+        df_final, pivots, 0, 0, 0, total_capital=capital, risk_per_trade=risk
+    )
+    status, instr, shares, cur_p, est_pct, forecast = res.status, res.instruction, res.suggested_shares, res.current_price, res.est_pct, res.forecast
+    stats = analyzer.run_backtest(df_final, pivots)
+    score = stats['win_rate'] * stats['count']
+    if is_valid: score += 500
+    
+    price_display = f"{cur_p:.4f}"
+    if est_pct != 0: price_display += f" ({est_pct:+.2f}%)"
+    if has_rt: price_display += " [Live]"
+    
+    return {
+        "名称": m_fund['name'], "代码": m_fund['code'], "状态": status, "指令": instr,
+        "实时估值": price_display, "建议仓位": f"{shares*cur_p:.0f}元",
+        "结构": struct_msg, "胜率": f"{stats['win_rate']:.0f}%", "评分": score,
+        "明日预测": f"{forecast['target']:.4f}"
+    }
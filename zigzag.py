@@ -0,0 +1,95 @@
+"""
+zig-zag 拐点状态机 (streamlit_app / ew_fund_quant / bot_cron 共用)。
+
+拐点：价格相对当前候选极值反向变动超过 deviation_pct 时确认前一个极值。
+extend 按段向量化求解，push 逐根 O(1) 追加，preview 试算一根盘中估值而不改状态。
+"""
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+
+class ZigZagTracker:
+    """
+    zig_zag 的状态机：已确认拐点 + 当前方向 / 候选极值。
+    extend 按段向量化求解 (每段一次累计极值)，push 逐根 O(1) 追加，拐点与逐点扫描完全一致。
+    """
+    __slots__ = ('deviation', 'n', 'start', 'direction', 'last_idx', 'last_date', 'last_val', 'confirmed')
+
+    def __init__(self, first_val, first_date, deviation_pct=0.05):
+        self.deviation = deviation_pct
+        self.n = 1
+        self.start = {'idx': 0, 'date': first_date, 'val': first_val, 'type': 'start'}
+        self.direction = 0; self.last_idx = 0; self.last_date = first_date; self.last_val = first_val
+        self.confirmed: List[Dict] = []
+
+    @classmethod
+    def from_series(cls, series: pd.Series, deviation_pct=0.05) -> 'ZigZagTracker':
+        values = series.to_numpy(dtype=float)
+        tracker = cls(values[0], series.index[0], deviation_pct)
+        tracker.extend(values[1:], series.index[1:])
+        return tracker
+
+    def _move(self, idx, date, val):
+        self.last_idx = idx; self.last_date = date; self.last_val = val
+
+    def _confirm(self):
+        self.confirmed.append({'idx': self.last_idx, 'date': self.last_date, 'val': self.last_val, 'type': 'high' if self.direction == 1 else 'low'})
+        self.direction = -self.direction
+
+    def extend(self, values, dates):
+        """批量追加新K线 (向量化)"""
+        y = np.asarray(values, dtype=float)
+        dev = self.deviation; pos = 0
+        while pos < len(y):
+            seg = y[pos:]
+            if self.direction == 0:
+                change = (seg - self.last_val) / self.last_val
+                hit = np.flatnonzero((change >= dev) | (change <= -dev))
+                if not len(hit): break
+                k = int(hit[0])
+                self.direction = 1 if change[k] >= dev else -1
+                self._move(self.n + pos + k, dates[pos + k], seg[k])
+            else:
+                # ext[j]: 处理 seg[j] 之前的候选极值 (NaN 不参与，与逐点比较一致)
+                acc = np.fmax if self.direction == 1 else np.fmin
+                ext = acc.accumulate(np.concatenate(([self.last_val], seg)))
+                change = (seg - ext[:-1]) / ext[:-1]
+                hit = np.flatnonzero(change <= -dev if self.direction == 1 else change >= dev)
+                k = int(hit[0]) if len(hit) else len(seg)
+                if ext[k] != self.last_val:
+                    # 候选极值被刷新：取首次出现的位置 (相等不刷新)
+                    j = int(np.argmax(seg[:k] == ext[k]))
+                    self._move(self.n + pos + j, dates[pos + j], seg[j])
+                if k == len(seg): break
+                self._confirm()
+                self._move(self.n + pos + k, dates[pos + k], seg[k])
+            pos += k + 1
+        self.n += len(y)
+
+    def push(self, val, date):
+        """追加一根K线 (O(1))"""
+        i = self.n; self.n += 1
+        change = (val - self.last_val) / self.last_val
+        if self.direction == 0:
+            if change >= self.deviation: self.direction = 1; self._move(i, date, val)
+            elif change <= -self.deviation: self.direction = -1; self._move(i, date, val)
+        elif self.direction == 1:
+            if val > self.last_val: self._move(i, date, val)
+            elif change <= -self.deviation: self._confirm(); self._move(i, date, val)
+        else:
+            if val < self.last_val: self._move(i, date, val)
+            elif change >= self.deviation: self._confirm(); self._move(i, date, val)
+
+    def preview(self, val, date) -> List[Dict]:
+        """带一根盘中估值的拐点序列，不改变自身状态"""
+        fork = ZigZagTracker.__new__(ZigZagTracker)
+        for name in self.__slots__: setattr(fork, name, getattr(self, name))
+        fork.confirmed = list(self.confirmed)
+        fork.push(val, date)
+        return fork.pivots()
+
+    def pivots(self) -> List[Dict]:
+        last = {'idx': self.last_idx, 'date': self.last_date, 'val': self.last_val, 'type': 'high' if self.direction == 1 else 'low'}
+        return [self.start, *self.confirmed, last]